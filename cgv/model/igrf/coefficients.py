@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+'''
+ coefficients.py
+
+    Registry of spherical harmonic (Gauss) coefficient sources, stored as
+    packed lower triangles: the coefficient of degree n and order m is
+    element n*(n+1)/2 + m of a flat array, so a degree N model needs
+    (N+1)(N+2)/2 numbers instead of a dense (N+1)x(N+1) matrix.
+
+    import coefficients
+    coefficients.sources()                     # ['igrf11', 'igrf12', ...]
+    igrf = coefficients.load('igrf12')         # read once per process
+    g, h = igrf.at(2012.5)                     # Schmidt semi-normalised [nT]
+
+    coefficients.register('wmm2015', lambda: coefficients.read_wmm('WMM.COF'))
+    coefficients.register('lith', lambda: coefficients.read_gauss('lith.txt', epoch=2010.0))
+
+    Parsers are provided for the IGRF table layout (any generation: epochs
+    are taken from the 'g/h n m' header line and the trailing secular
+    variation column such as '2015-20' is turned into an extra epoch),
+    WMM style .COF files, and plain "n m g h [dg dh]" Gauss coefficient
+    files.  The embedded IGRF tables are registered by igrf_model.py.
+'''
+
+import numpy as np
+import unittest
+
+
+def index(n, m):
+    """ Position of degree n, order m in a packed triangular array. """
+    return n*(n+1)//2 + m
+
+def size(degree):
+    """ Number of packed coefficients up to and including degree. """
+    return (degree+1)*(degree+2)//2
+
+def degrees(degree):
+    """ Degree n and order m of every packed coefficient. """
+    n = np.repeat( np.arange(degree+1), np.arange(degree+1)+1 )
+    m = np.arange(size(degree)) - n*(n+1)//2
+    return n, m
+
+
+class gaussCoefficients(object):
+    """
+    Schmidt semi-normalised Gauss coefficients [nT] at one or more epochs,
+    with linear interpolation in time (clipped to the first/last epoch).
+    """
+
+    def __init__(self, name, epochs, g, h, radius=6371.2e3):
+        order = np.argsort(epochs)
+        self.name = name
+        self.epochs = np.asarray(epochs, dtype='float')[order]
+        self.g = np.atleast_2d( np.asarray(g, dtype='float') )[order]
+        self.h = np.atleast_2d( np.asarray(h, dtype='float') )[order]
+        self.radius = radius   ;# reference radius [m]
+        self.degree = int( np.round( (np.sqrt(8*self.g.shape[1] + 1) - 3) / 2 ) )
+        if size(self.degree) != self.g.shape[1]:
+            raise ValueError('%d coefficients is not a complete triangle' % self.g.shape[1])
+
+
+    def at(self, year):
+        """ Packed (g, h) at a given decimal year. """
+        k = np.searchsorted(self.epochs, year, side='right') - 1
+        if k < 0: return self.g[0].copy(), self.h[0].copy()
+        if k >= len(self.epochs)-1: return self.g[-1].copy(), self.h[-1].copy()
+        dy = (year - self.epochs[k]) / (self.epochs[k+1] - self.epochs[k])
+        return self.g[k] + dy*(self.g[k+1] - self.g[k]), self.h[k] + dy*(self.h[k+1] - self.h[k])
+
+
+    def dense(self, packed, shape=None):
+        """ Expand a packed array into a [m,n] indexed matrix (as used by igrfModel). """
+        n, m = degrees(self.degree)
+        shape = (self.degree+1,)*2 if shape is None else shape
+        result = np.zeros(shape)
+        result[m,n] = packed
+        return result
+        ########################################################################
+
+
+_registry = {}   ;# name -> function returning gaussCoefficients
+_loaded = {}     ;# name -> gaussCoefficients, read once per process
+
+def register(name, loader):
+    """ Add (or replace) a coefficient source; loader() is only called when first needed. """
+    _registry[name] = loader
+    _loaded.pop(name, None)
+
+def sources():
+    return sorted(_registry)
+
+def load(name):
+    if name not in _loaded:
+        if name not in _registry:
+            raise KeyError('unknown coefficient source %s, expected one of %s' % (name, sources()))
+        _loaded[name] = _registry[name]()
+    return _loaded[name]
+
+
+def _text(source):
+    """ Accept either the contents of a file or its name. """
+    return source if '\n' in source else open(source).read()
+
+
+def parse_igrf(source, name='igrf'):
+    """
+    IGRF coefficient table, eg. https://www.ngdc.noaa.gov/IAGA/vmod/igrf12coeffs.txt
+    A final secular variation column 'YYYY-YY' [nT/year] becomes an extra
+    epoch at the end of the range.
+    """
+    lines = [line.split() for line in _text(source).splitlines()]
+    header = [i for i, parts in enumerate(lines) if parts[0:1] == ['g/h']]
+    if not header:
+        raise ValueError('no g/h n m header line in IGRF table')
+    columns = lines[header[0]][3:]
+    data = [parts for parts in lines[header[0]+1:] if parts[0:1] in (['g'], ['h'])]
+    degree = max( int(parts[1]) for parts in data )
+
+    epochs, sv = [], None
+    for column in columns:
+        if '-' in column:   # secular variation, eg. 2015-20 or 2020-25
+            start, end = column.split('-')
+            sv = float(start[:len(start)-len(end)] + end) - float(start)
+        else:
+            epochs.append( float(column) )
+    g = np.zeros( [len(epochs) + (sv is not None), size(degree)] )  ;  h = np.zeros_like(g)
+    for parts in data:
+        n, m = int(parts[1]), int(parts[2])
+        values = np.array(parts[3:], dtype='float')
+        target = g if parts[0] == 'g' else h
+        target[0:len(epochs), index(n,m)] = values[0:len(epochs)]
+        if sv is not None:
+            target[-1, index(n,m)] = values[len(epochs)-1] + sv * values[len(epochs)]
+    if sv is not None: epochs.append( epochs[-1] + sv )
+    return gaussCoefficients(name, epochs, g, h)
+
+
+def read_gauss(source, epoch=0.0, name=None, radius=6371.2e3, years=5.0):
+    """
+    Plain Gauss coefficient file with one "n m g h [dg dh]" line per
+    coefficient (lines starting with # are ignored).  If secular variation
+    dg, dh [nT/year] is present a second epoch is added after years.
+    """
+    rows = []
+    for line in _text(source).splitlines():
+        parts = line.split('#')[0].split()
+        if len(parts) < 4: continue
+        try: rows.append( [float(value) for value in parts[0:6]] )
+        except ValueError: continue
+    rows = np.array( [row + [0.0]*(6-len(row)) for row in rows] )
+    rows = rows[ rows[:,0] < 9999 ]   ;# end of file marker
+    degree = int( rows[:,0].max() )
+    k = index( rows[:,0].astype('int'), rows[:,1].astype('int') )
+    g = np.zeros( [2, size(degree)] )  ;  h = np.zeros_like(g)
+    g[0,k], h[0,k] = rows[:,2], rows[:,3]
+    g[1,k], h[1,k] = rows[:,2] + years*rows[:,4], rows[:,3] + years*rows[:,5]
+    if not np.any(rows[:,4:]):
+        return gaussCoefficients(name or 'gauss', [epoch], g[0:1], h[0:1], radius=radius)
+    return gaussCoefficients(name or 'gauss', [epoch, epoch + years], g, h, radius=radius)
+
+
+def read_wmm(source, name=None):
+    """ World Magnetic Model .COF file: epoch and model name on the first line. """
+    text = _text(source)
+    first = text.strip().splitlines()[0].split()
+    return read_gauss(text, epoch=float(first[0]), name=name or first[1])
+    ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    table = '''
+# test table
+c/s deg ord IGRF IGRF SV
+g/h n m 2000.0 2005.0 2005-10
+g 1 0 -100 -90 2.0
+g 1 1 -10 -11 0.0
+h 1 1 30 31 -1.0
+g 2 0 5 6 0.0
+'''
+
+    def test_packing(self):
+        n, m = degrees(3)
+        self.assertEqual( len(n), size(3) )
+        self.assertTrue( np.all( index(n, m) == np.arange(size(3)) ) )
+
+    def test_igrf(self):
+        c = parse_igrf(self.table)
+        self.assertEqual( c.degree, 2 )
+        self.assertTrue( np.all( c.epochs == [2000.0, 2005.0, 2010.0] ) )
+        g, h = c.at(2002.5)
+        self.assertAlmostEqual( g[index(1,0)], -95.0 )
+        g, h = c.at(2010.0)
+        self.assertAlmostEqual( g[index(1,0)], -80.0 )
+        self.assertAlmostEqual( h[index(1,1)], 26.0 )
+        self.assertEqual( c.dense(g)[1,1], -11.0 )
+
+    def test_wmm(self):
+        text = '''    2015.0            WMM-2015        12/15/2014
+  1  0  -29438.5       0.0       10.7        0.0
+  1  1   -1501.1    4796.2       17.9      -26.8
+999999999999999999999999999999999999999999999999
+'''
+        c = read_wmm(text)
+        self.assertEqual( c.name, 'WMM-2015' )
+        self.assertAlmostEqual( c.at(2017.5)[0][index(1,0)], -29438.5 + 2.5*10.7 )
+
+    def test_registry(self):
+        register('test', lambda: parse_igrf(self.table, 'test'))
+        self.assertTrue( 'test' in sources() )
+        self.assertTrue( load('test') is load('test') )
+        self.assertRaises( KeyError, load, 'nonexistent' )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+'''
+ dbdt.py
+
+    Rate of change of the magnetic field (dB/dt) from magnetometer time
+    series, for geomagnetically induced current (GIC) monitoring.
+
+    from dbdt import dbdt, dbdtStream
+    result = dbdt(time, B, window=60)            # B is (stations, samples, 3) ENU
+    result['horizontal'], result['maximum']
+
+    engine = dbdtStream(stations=300, window=600)
+    for time, B in chunks:
+        result = engine.update(time, B)           # same keys, one chunk at a time
+
+    baseline = stationBaseline(positions, start=np.datetime64('2015-03-17'))
+    engine = dbdtStream(stations=300, window=600, baseline=baseline)
+
+    Vectors follow the ENU convention of igrfModel.geographic(): the last
+    axis holds (east, north, up) in nanoTesla and time is in seconds.  The
+    derivative of each sample is the backward difference to the previous
+    valid sample of the same station; it is NaN if the gap between them is
+    larger than max_gap or either sample is missing (NaN).  Set a baseline
+    (eg. stationBaseline, the IGRF field at each station and sample time)
+    to difference residuals rather than the total field.
+'''
+
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+from residual import decimal_year, knotCache
+
+
+def rolling_max(values, window):
+    """
+    Maximum over the last window samples along the final axis, ignoring
+    NaN.  The first window-1 outputs use the samples that are available.
+    The running maximum filter is O(samples) regardless of the window.
+    """
+    from scipy.ndimage import maximum_filter1d
+    values = np.where( np.isnan(values), -np.inf, np.asarray(values, dtype='float') )
+    result = maximum_filter1d(values, window, axis=-1, mode='constant', cval=-np.inf, origin=(window-1)//2)
+    result[ np.isinf(result) ] = np.nan
+    return result
+
+
+def difference(time, B, max_gap=None, previous=None):
+    """
+    Gap-aware backward difference dB/dt [nT/s] of B (stations, samples, 3)
+    sampled at time (samples,) or (stations, samples).  previous is an
+    optional (time, B) of the last valid sample of each station before
+    this block, ie. (stations,) and (stations, 3).
+    """
+    B = np.asarray(B, dtype='float')
+    time = np.broadcast_to( np.asarray(time, dtype='float'), B.shape[:-1] )
+    valid = np.all( np.isfinite(B), axis=-1 )
+    nstations, nsamples = valid.shape
+
+    # index of the last valid sample before each sample, without looping over samples
+    position = np.where( valid, np.arange(nsamples), -1 )
+    last = np.maximum.accumulate(position, axis=-1)
+    before = np.concatenate( [np.full([nstations,1], -1), last[:,:-1]], axis=-1 )
+
+    rows = np.arange(nstations)[:,None]
+    t0 = time[rows, np.maximum(before,0)]
+    B0 = B[rows, np.maximum(before,0)]
+    if previous is not None:
+        t0 = np.where( before >= 0, t0, np.asarray(previous[0], dtype='float')[:,None] )
+        B0 = np.where( (before >= 0)[...,None], B0, np.asarray(previous[1], dtype='float')[:,None,:] )
+    else:
+        t0 = np.where( before >= 0, t0, np.nan )
+
+    dt = time - t0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = (B - B0) / dt[...,None]
+        bad = ~valid | ~(dt > 0)
+        if max_gap is not None: bad |= ~(dt <= max_gap)
+    rate[bad] = np.nan
+    return rate
+
+
+def dbdt(time, B, window=60, max_gap=None, baseline=None):
+    """
+    dB/dt for whole (stations, samples, 3) arrays of ENU vectors [nT].
+
+    Returns a dict with the vector rate 'dbdt' [nT/s], its 'horizontal'
+    magnitude sqrt(dE^2 + dN^2) and the rolling 'maximum' of the horizontal
+    magnitude over window samples.  baseline, if given, is subtracted first:
+    an array that broadcasts against B, or a callable (time, B) -> array
+    such as stationBaseline.
+    """
+    B = np.asarray(B, dtype='float')
+    if baseline is not None:
+        B = B - ( baseline(time, B) if callable(baseline) else baseline )
+    rate = difference(time, B, max_gap=max_gap)
+    horizontal = np.sqrt( rate[...,0]**2 + rate[...,1]**2 )
+    return {'dbdt':rate, 'horizontal':horizontal, 'maximum':rolling_max(horizontal, window)}
+
+
+class stationBaseline(object):
+    """
+    Main field at fixed stations for every sample time, as a dB/dt baseline.
+    The model is evaluated for all stations at once on knots every step
+    seconds and interpolated linearly in between (residual.knotCache),
+    which is exact within an IGRF epoch, so there are no steps at knot
+    boundaries to appear as spurious dB/dt.
+    """
+
+    def __init__(self, positions, start, step=86400.0, model=igrfModel, cache_size=10000):
+        self.positions = np.atleast_2d( np.asarray(positions, dtype='float') )   ;# (stations, 3) height, lat, lon
+        self.start = start      ;# datetime64 or decimal year of time = 0 seconds
+        self.field = knotCache(step / (365.25*86400.0), cache_size=cache_size, model=model)
+
+
+    def year(self, seconds):
+        """ Decimal year of times in seconds since start. """
+        seconds = np.asarray(seconds, dtype='float')
+        if np.issubdtype( np.asarray(self.start).dtype, np.datetime64 ):
+            return decimal_year( np.datetime64(self.start, 'ns') + np.round(seconds*1e9).astype('int64').astype('timedelta64[ns]') )
+        return self.start + seconds / (365.25*86400.0)
+
+
+    def __call__(self, time, B=None):
+        """ ENU field [nT] (stations, samples, 3) at time [s] of shape (samples,) or (stations, samples). """
+        time = np.asarray(time, dtype='float')
+        shape = ( len(self.positions), time.shape[-1] )
+        year = np.broadcast_to( self.year(time), shape )
+        position = np.broadcast_to( self.positions[:,None,:], shape + (3,) )
+        return self.field( year.ravel(), position.reshape(-1,3) ).reshape( shape + (3,) )
+        ########################################################################
+
+
+class dbdtStream(object):
+    """
+    Incremental dB/dt for live data from many stations.  Ring buffers hold
+    the last valid sample of each station and the recent horizontal rates,
+    so memory does not grow with the length of the stream.
+    """
+
+    def __init__(self, stations, window=60, max_gap=None, baseline=None):
+        self.stations = stations
+        self.window = window
+        self.max_gap = max_gap
+        self.baseline = baseline   ;# callable (time, B) -> baseline (eg. stationBaseline), or array, or None
+        self.last_time = np.full(stations, np.nan)
+        self.last_B = np.full([stations,3], np.nan)
+        self.ring = np.full([stations, window], np.nan)   ;# horizontal dB/dt, oldest first
+        self.count = 0   ;# samples processed
+
+
+    def update(self, time, B):
+        """ dB/dt for the next chunk of (stations, samples, 3) ENU vectors. """
+        B = np.asarray(B, dtype='float')
+        if self.baseline is not None:
+            B = B - ( self.baseline(time, B) if callable(self.baseline) else self.baseline )
+        time = np.broadcast_to( np.asarray(time, dtype='float'), B.shape[:-1] )
+        rate = difference(time, B, max_gap=self.max_gap, previous=(self.last_time, self.last_B))
+        horizontal = np.sqrt( rate[...,0]**2 + rate[...,1]**2 )
+
+        # rolling maximum continues across the chunk boundary
+        history = np.concatenate( [self.ring, horizontal], axis=-1 )
+        maximum = rolling_max(history, self.window)[:, self.window:]
+
+        # keep the last valid sample of every station and the last window rates
+        valid = np.all( np.isfinite(B), axis=-1 )
+        nsamples = valid.shape[1]
+        last = np.max( np.where(valid, np.arange(nsamples), -1), axis=-1 )
+        update = last >= 0
+        self.last_time[update] = time[update, last[update]]
+        self.last_B[update] = B[update, last[update]]
+        self.ring = history[:, -self.window:]
+        self.count += nsamples
+
+        return {'dbdt':rate, 'horizontal':horizontal, 'maximum':maximum}
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = np.arange(200.0)
+        self.B = np.zeros([2, 200, 3])
+        self.B[0,:,0] = 3.0 * self.time    ;# 3 nT/s east
+        self.B[1,:,1] = 4.0 * self.time    ;# 4 nT/s north
+        self.B[1,100:150,1] += 10.0         ;# 10 nT step at sample 100
+
+    def test_dbdt(self):
+        result = dbdt(self.time, self.B, window=10)
+        self.assertTrue( np.all( np.isnan(result['dbdt'][:,0]) ) )
+        self.assertTrue( np.allclose( result['horizontal'][0,1:], 3.0 ) )
+        self.assertAlmostEqual( result['horizontal'][1,100], 14.0 )
+        self.assertAlmostEqual( result['maximum'][1,109], 14.0 )
+        self.assertAlmostEqual( result['maximum'][1,110], 4.0 )
+
+    def test_gaps(self):
+        B = self.B.copy()  ;  B[0,50:55] = np.nan
+        rate = difference(self.time, B, max_gap=3.0)
+        self.assertTrue( np.all( np.isnan(rate[0,50:56]) ) )   ;# 6 second gap is too long
+        rate = difference(self.time, B, max_gap=10.0)
+        self.assertAlmostEqual( rate[0,55,0], 3.0 )             ;# bridged
+
+    def test_stream(self):
+        engine = dbdtStream(2, window=10)
+        chunks = [ engine.update(self.time[i:i+37], self.B[:,i:i+37]) for i in range(0, 200, 37) ]
+        expect = dbdt(self.time, self.B, window=10)
+        for name in ['horizontal', 'maximum']:
+            joined = np.concatenate( [chunk[name] for chunk in chunks], axis=-1 )
+            self.assertTrue( np.allclose( joined, expect[name], equal_nan=True ) )
+        self.assertEqual( engine.count, 200 )
+
+    def test_baseline(self):
+        # two days of 1 minute samples: only the 3 nT/s ramp is left, no steps between days
+        positions = np.array( [[0.0, 51.0, 246.0], [0.0, 65.0, 213.0]] )
+        baseline = stationBaseline(positions, start=np.datetime64('2015-03-17'))
+        time = np.arange(0.0, 2*86400.0, 60.0)
+        check = baseline( np.array([0.0, 129600.0]) )
+        for i, t in enumerate([0.0, 129600.0]):
+            year = float( decimal_year( np.datetime64('2015-03-17') + np.timedelta64(int(t),'s') ) )
+            b = igrfModel(year).geographic(0.0, positions[:,1], positions[:,2])['field']
+            self.assertTrue( np.allclose( check[:,i], np.column_stack( [b['east'], b['north'], b['up']] ), atol=1e-6 ) )
+
+        B = baseline(time) + ( 3.0 * time )[None,:,None] * np.array([1.0, 0.0, 0.0])
+        engine = dbdtStream(2, window=10, baseline=stationBaseline(positions, start=np.datetime64('2015-03-17')))
+        rates = np.concatenate( [ engine.update(time[i:i+500], B[:,i:i+500])['horizontal'] for i in range(0, len(time), 500) ], axis=-1 )
+        self.assertTrue( np.allclose( rates[:,1:], 3.0, atol=1e-9 ) )
+        self.assertTrue( np.allclose( dbdt(time, B, baseline=baseline)['horizontal'][:,1:], 3.0, atol=1e-9 ) )
+        self.assertTrue( engine.baseline.field.calls <= 2*4 )   ;# each station once per knot, not per sample
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''
+ design.py
+
+    Design matrices and normal equations for least squares fitting of
+    Schmidt semi-normalised Gauss coefficients to vector field data.
+
+    from design import normalEquations
+    fit = normalEquations(degree=13)
+    for chunk in chunks:                          # eg. np.load(..., mmap_mode='r')
+        fit.geographic(chunk['height'], chunk['latitude'], chunk['longitude'],
+                       {'north':chunk['X'], 'east':chunk['Y'], 'up':-chunk['Z']})
+    g, h = fit.solve()                            # packed, as used by gaussModel
+    print fit.rms(g, h)
+
+    Each observed component is linear in the coefficients, B = A x, where
+    x holds g_10, g_11, h_11, g_20, g_21, h_21, ... (the usual order of
+    coefficient tables).  The rows of A are built with the same Legendre
+    recurrence, trigonometric and radial tables as harmonics.gaussModel, a
+    block of points at a time, and only the normal equations A'WA and
+    A'Wb (size degree*(degree+2) squared) are kept, so the number of
+    observations is limited by time rather than memory.
+'''
+
+import numpy as np
+import unittest
+
+import coefficients
+from harmonics import legendre
+from igrf_model import igrfModel
+
+
+def columns(degree):
+    """ Coefficient type ('g' or 'h'), degree n and order m of every column. """
+    kind, n, m = [], [], []
+    for k in range(1, degree+1):
+        for j in range(k+1):
+            kind.append('g')  ;  n.append(k)  ;  m.append(j)
+            if j > 0:
+                kind.append('h')  ;  n.append(k)  ;  m.append(j)
+    return np.array(kind), np.array(n), np.array(m)
+
+
+def pack(g, h, degree):
+    """ Parameter vector x from packed g, h (see coefficients.py). """
+    kind, n, m = columns(degree)
+    k = coefficients.index(n, m)
+    return np.where( kind == 'g', np.asarray(g)[k], np.asarray(h)[k] )
+
+
+def unpack(x, degree):
+    """ Packed g, h from a parameter vector x. """
+    kind, n, m = columns(degree)
+    g, h = np.zeros(coefficients.size(degree)), np.zeros(coefficients.size(degree))
+    k = coefficients.index(n, m)
+    g[ k[kind == 'g'] ] = x[kind == 'g']
+    h[ k[kind == 'h'] ] = x[kind == 'h']
+    return g, h
+
+
+def design_matrix(r, theta, phi, degree, radius=6371.2e3, components=('r','theta','phi'), psi=None):
+    """
+    Rows of the design matrix for each requested component at spherical
+    positions: dict of (npoints, degree*(degree+2)) arrays.  Geodetic
+    'north', 'east', 'up' components need the geodetic minus geocentric
+    latitude psi [radians] (see igrfModel.convert_coordinates).
+    """
+    unknown = set(components) - set(['r', 'theta', 'phi', 'north', 'east', 'up'])
+    if unknown:
+        raise ValueError('unknown components %s' % sorted(unknown))
+    r, theta, phi = np.broadcast_arrays( np.asarray(r, dtype='float'),
+                                         np.clip(theta, 1.0e-6, np.pi-1.0e-6), np.asarray(phi, dtype='float') )
+    shape = r.shape
+    r, theta, phi = r.ravel(), theta.ravel(), phi.ravel()
+    npoints, nparams = r.size, degree*(degree+2)
+
+    rr = radius / r
+    mphi = np.arange(degree+1)[:,None] * phi
+    cphi, sphi = np.cos(mphi), np.sin(mphi)
+    A = dict( (name, np.empty([npoints, nparams])) for name in ['r', 'theta', 'phi'] )
+    rn = rr**2   ;# (a/r)^(n+2) for n=0
+    start = 0
+    for n, (P, dP) in enumerate( legendre(theta, degree) ):
+        if n == 0: continue
+        rn = rn * rr
+        scale = rn / np.sqrt(2.0*n + 1)   ;# fully normalised -> Schmidt, times (a/r)^(n+2)
+        m = np.arange(n+1)[:,None]
+        g = {'r':(n+1) * scale * cphi[0:n+1] * P, 'theta':-scale * cphi[0:n+1] * dP,
+             'phi':scale * m * sphi[0:n+1] * P / np.sin(theta)}
+        h = {'r':(n+1) * scale * sphi[0:n+1] * P, 'theta':-scale * sphi[0:n+1] * dP,
+             'phi':-scale * m * cphi[0:n+1] * P / np.sin(theta)}
+        # columns g_n0, g_n1, h_n1, g_n2, h_n2, ...
+        for name in A:
+            A[name][:, start] = g[name][0]
+            A[name][:, start+1:start+2*n+1:2] = g[name][1:].T
+            A[name][:, start+2:start+2*n+1:2] = h[name][1:].T
+        start += 2*n + 1
+
+    if psi is not None:
+        psi = np.broadcast_to(psi, shape).ravel()[:,None]
+        A['north'] = -A['theta'] * np.cos(psi) - A['r'] * np.sin(psi)
+        A['up'] = -( A['theta'] * np.sin(psi) - A['r'] * np.cos(psi) )
+    A['east'] = A['phi']
+    missing = set(components) - set(A)
+    if missing:
+        raise ValueError('components %s need the geodetic correction psi' % sorted(missing))
+    return dict( (name, A[name].reshape(shape + (nparams,))) for name in components )
+
+
+class normalEquations(object):
+    """
+    Out-of-core accumulation of weighted normal equations for Gauss
+    coefficient fits: add observations in blocks, then solve().
+    """
+
+    def __init__(self, degree=13, radius=6371.2e3, chunk=20000):
+        self.degree = degree
+        self.radius = radius
+        self.chunk = chunk    ;# points per design matrix block, bounds temporary memory
+        nparams = degree*(degree+2)
+        self.N = np.zeros([nparams, nparams])   ;# A'WA
+        self.b = np.zeros(nparams)              ;# A'Wd
+        self.dd = 0.0                           ;# d'Wd, for the residual
+        self.count = 0                          ;# number of observations
+        self._model = None
+
+
+    def spherical(self, r, theta, phi, data, weights=None, psi=None):
+        """
+        Add observations at spherical positions.  data is a dict of
+        component name -> values [nT] (any of r, theta, phi and, with psi,
+        north, east, up), weights a matching dict, array or None.
+        """
+        names = sorted(data)
+        r, theta, phi = [ np.ravel(v) for v in np.broadcast_arrays(r, theta, phi) ]
+        psi = None if psi is None else np.broadcast_to(psi, r.shape).ravel()
+        if weights is None: weights = 1.0
+        for start in range(0, r.size, self.chunk):
+            s = slice(start, start+self.chunk)
+            A = design_matrix(r[s], theta[s], phi[s], self.degree, self.radius, names,
+                              psi=None if psi is None else psi[s])
+            for name in names:
+                d = np.ravel( data[name] )[s]
+                w = np.broadcast_to( weights[name] if isinstance(weights, dict) else weights, r.shape )[s]
+                ok = np.isfinite(d) & (w > 0)
+                a, d, w = A[name][ok], d[ok], w[ok]
+                self.N += np.dot( a.T, a * w[:,None] )
+                self.b += np.dot( a.T, w * d )
+                self.dd += np.sum( w * d * d )
+                self.count += len(d)
+        return self
+
+
+    def geographic(self, height, latitude, longitude, data, weights=None):
+        """ Add observations at geodetic positions, eg. {'north':X, 'east':Y, 'up':-Z} """
+        if self._model is None: self._model = igrfModel()   ;# only for the WGS-84 conversion
+        coords = self._model.convert_coordinates(height=np.asarray(height, dtype='float'),
+                    latitude=np.asarray(latitude, dtype='float'), longitude=np.asarray(longitude, dtype='float'))
+        return self.spherical(coords['r'], coords['theta'], coords['phi'], data, weights, psi=coords['psi'])
+
+
+    def solve(self, damping=0.0):
+        """ Packed g, h [nT] minimising the weighted misfit, with optional ridge damping. """
+        import scipy.linalg
+        N = self.N + damping * np.eye(len(self.b))
+        x = scipy.linalg.cho_solve( scipy.linalg.cho_factor(N), self.b )
+        return unpack(x, self.degree)
+
+
+    def rms(self, g, h):
+        """ Weighted root mean square residual [nT] of coefficients g, h, without another pass over the data. """
+        x = pack(g, h, self.degree)
+        misfit = self.dd - 2*np.dot(x, self.b) + np.dot(x, np.dot(self.N, x))
+        return np.sqrt( max(misfit, 0.0) / max(self.count, 1) )
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        from harmonics import gaussModel
+        self.model = gaussModel(2015.0, degree=13)
+        random = np.random.RandomState(2)
+        self.height = random.uniform(0.0, 800e3, 3000)
+        self.latitude = np.degrees( np.arcsin( random.uniform(-1, 1, 3000) ) )
+        self.longitude = random.uniform(0.0, 360.0, 3000)
+
+    def test_packing(self):
+        kind, n, m = columns(3)
+        self.assertEqual( len(kind), 3*5 )
+        self.assertEqual( list(zip(kind, n, m))[0:4], [('g',1,0), ('g',1,1), ('h',1,1), ('g',2,0)] )
+        g, h = unpack( pack(self.model.g, self.model.h, 13), 13 )
+        self.assertTrue( np.all( g[1:] == self.model.g[1:coefficients.size(13)] ) )
+
+    def test_design(self):
+        # A x reproduces the synthesized field
+        x = pack(self.model.g, self.model.h, 13)
+        coords = self.model.convert_coordinates(height=self.height[0:50], latitude=self.latitude[0:50],
+                                                longitude=self.longitude[0:50])
+        A = design_matrix(coords['r'], coords['theta'], coords['phi'], 13, components=['r', 'phi', 'north', 'up'],
+                          psi=coords['psi'])
+        b = self.model.geographic(self.height[0:50], self.latitude[0:50], self.longitude[0:50])['field']
+        for name in ['north', 'up']:
+            self.assertTrue( np.allclose( np.dot(A[name], x), b[name], rtol=1e-10, atol=1e-6 ) )
+        self.assertTrue( np.allclose( np.dot(A['phi'], x), b['east'], rtol=1e-10, atol=1e-6 ) )
+        self.assertRaises( ValueError, design_matrix, 7e6, 1.0, 1.0, 3, components=['north'] )
+
+    def test_fit(self):
+        # blocks of 500 points recover the coefficients used to make the data
+        b = self.model.geographic(self.height, self.latitude, self.longitude)['field']
+        data = dict( (name, b[name] + np.random.RandomState(3).normal(0.0, 1.0, 3000)) for name in ['north', 'east', 'up'] )
+        fit = normalEquations(degree=13, chunk=500)
+        for k in range(0, 3000, 1000):
+            s = slice(k, k+1000)
+            fit.geographic(self.height[s], self.latitude[s], self.longitude[s],
+                           dict( (name, data[name][s]) for name in data ))
+        self.assertEqual( fit.count, 9000 )
+        g, h = fit.solve()
+        self.assertTrue( np.all( np.abs( g[1:3] - self.model.g[1:3] ) < 0.1 ) )
+        self.assertTrue( np.abs( fit.rms(g, h) - 1.0 ) < 0.05 )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+'''
+ grid.py
+
+    Lazy, labelled field values on (epoch, height, latitude, longitude)
+    grids: nothing is calculated until values are read or reduced, and
+    then only the chunks that are needed.
+
+    from grid import gridQuery
+    cube = gridQuery(epochs=range(1900, 2021), heights=[0.0, 100e3, 400e3],
+                     latitudes=np.arange(-90, 90.1, 0.5), longitudes=np.arange(0, 360, 0.5),
+                     outputs=('F','D','I'))
+    cube.dims, cube.shape, cube.coords['latitude']
+    D = cube['D'].sel(epoch=2015, height=0.0, latitude=slice(40, 60))   # still lazy
+    D.values                                                               # computes 1 chunk row
+    cube['F'].mean('longitude').values                                     # chunk by chunk reduction
+
+    The cube is divided into chunks (sizes given per dimension).  Each
+    chunk is one vectorized geographic() call per epoch that calculates all
+    the requested quantities, and is kept in an LRU cache of cache_size
+    chunks, so repeated or overlapping slices do not calculate it again.
+    Reductions (sum, mean, min, max) combine partial results chunk by chunk,
+    so memory is bounded by the chunk size and the size of the result.
+'''
+
+import collections
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+class gridQuery(object):
+    """
+    Lazy description of field values on a grid, computed and cached by chunk.
+    """
+
+    dims = ('epoch', 'height', 'latitude', 'longitude')
+
+    def __init__(self, epochs, heights, latitudes, longitudes, outputs=('north','east','up'),
+                 chunks=None, cache_size=64, model=igrfModel, verbose=0):
+        self.coords = collections.OrderedDict( (name, np.atleast_1d( np.asarray(values, dtype='float') ))
+                                               for name, values in zip(self.dims, [epochs, heights, latitudes, longitudes]) )
+        self.shape = tuple( len(values) for values in self.coords.values() )
+        factory = model
+        self.quantities = [ factory.aliases.get(name, name) for name in outputs ]
+        for name in self.quantities:
+            if name not in factory.provides['geographic']:
+                raise ValueError('unknown output %s, expected one of %s' % (name, sorted(factory.provides['geographic'])))
+        default = {'epoch':1, 'height':1, 'latitude':90, 'longitude':180}
+        chunks = dict(default, **(chunks or {}))
+        self.chunks = tuple( max(1, min(chunks[name], n)) for name, n in zip(self.dims, self.shape) )
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()   ;# chunk index -> {quantity: array}, least recent first
+        self.factory = factory
+        self.models = {}
+        self.computed = 0   ;# chunks calculated so far
+        self.verbose = verbose
+
+
+    def __getitem__(self, quantity):
+        quantity = self.factory.aliases.get(quantity, quantity)
+        if quantity not in self.quantities:
+            raise KeyError('%s was not requested, expected one of %s' % (quantity, self.quantities))
+        return gridArray(self, quantity, [np.arange(n) for n in self.shape], self.dims)
+
+
+    def __repr__(self):
+        return '<gridQuery %s %s, chunks %s, %d of %d chunks computed>' % (
+            ', '.join(self.quantities), dict(zip(self.dims, self.shape)), self.chunks,
+            len(self.cache), int( np.prod( [-(-n // c) for n, c in zip(self.shape, self.chunks)] ) ))
+
+
+    def model(self, epoch):
+        if epoch not in self.models:
+            self.models[epoch] = self.factory(epoch)
+        return self.models[epoch]
+
+
+    def chunk(self, key):
+        """ All quantities of one chunk (tuple of chunk numbers), from the cache if possible. """
+        if key in self.cache:
+            self.cache[key] = self.cache.pop(key)   ;# most recent
+            return self.cache[key]
+        ranges = [ values[k*c:(k+1)*c] for values, k, c in zip(self.coords.values(), key, self.chunks) ]
+        epochs, (height, latitude, longitude) = ranges[0], np.meshgrid( *ranges[1:], indexing='ij' )
+        result = dict( (name, np.empty( (len(epochs),) + height.shape )) for name in self.quantities )
+        for i, epoch in enumerate(epochs):
+            b = self.model(epoch).geographic(height, latitude, longitude, metadata=False, outputs=self.quantities)['field']
+            for name in self.quantities: result[name][i] = b[name]
+        self.cache[key] = result
+        self.computed += 1
+        while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+        if self.verbose: print('computed chunk %s' % (key,))
+        return result
+
+
+    def compute(self):
+        """ Every quantity on the whole grid, as {'field':{...}, 'position':{...}} """
+        field = dict( (name, self[name].values) for name in self.quantities )
+        return {'field':field, 'position':dict(self.coords)}
+        ########################################################################
+
+
+class gridArray(object):
+    """
+    One quantity on a selection of a gridQuery: named dimensions, label and
+    index selection, and chunk by chunk reductions.  Nothing is computed
+    until .values (or a reduction's .values) is used.
+    """
+
+    def __init__(self, grid, quantity, index, dims, reduce=None):
+        self.grid = grid
+        self.quantity = quantity
+        self.index = index     ;# selected positions along every grid dimension
+        self.dims = dims       ;# dimensions that are kept in the result
+        self.reduction = reduce   ;# (operation, dimensions) or None
+
+
+    @property
+    def shape(self):
+        return tuple( len(self.index[self.grid.dims.index(name)]) for name in self.dims )
+
+    @property
+    def coords(self):
+        return collections.OrderedDict( (name, self.grid.coords[name][self.index[self.grid.dims.index(name)]])
+                                        for name in self.dims )
+
+    def __repr__(self):
+        return '<gridArray %s %s%s>' % (self.quantity, dict(zip(self.dims, self.shape)),
+                                        '' if self.reduction is None else ' %s over %s' % self.reduction)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.values, dtype=dtype)
+
+
+    def isel(self, **selection):
+        """ Select by position along named dimensions (integers drop the dimension). """
+        if self.reduction is not None:
+            raise ValueError('select before reducing')
+        index, dims = list(self.index), list(self.dims)
+        for name, value in selection.items():
+            if name not in dims:
+                raise ValueError('unknown dimension %s, expected one of %s' % (name, dims))
+            k = self.grid.dims.index(name)
+            index[k] = np.atleast_1d( index[k][value] )
+            if np.ndim(value) == 0 and not isinstance(value, slice): dims.remove(name)
+        return gridArray(self.grid, self.quantity, index, tuple(dims))
+
+
+    def sel(self, **selection):
+        """
+        Select by coordinate value: a slice is an inclusive range of labels,
+        anything else is matched to the nearest label(s).
+        """
+        positions = {}
+        for name, value in selection.items():
+            labels = self.coords[name] if name in self.dims else None
+            if labels is None:
+                raise ValueError('unknown dimension %s, expected one of %s' % (name, list(self.dims)))
+            if isinstance(value, slice):
+                low = -np.inf if value.start is None else value.start
+                high = np.inf if value.stop is None else value.stop
+                positions[name] = np.flatnonzero( (labels >= low) & (labels <= high) )
+            else:
+                nearest = np.argmin( np.abs( labels[:,None] - np.atleast_1d(value)[None,:] ), axis=0 )
+                positions[name] = nearest[0] if np.ndim(value) == 0 else nearest
+        return self.isel(**positions)
+
+
+    def _reduce(self, operation, dims):
+        dims = [dims] if isinstance(dims, str) else list(self.dims if dims is None else dims)
+        for name in dims:
+            if name not in self.dims:
+                raise ValueError('unknown dimension %s, expected one of %s' % (name, list(self.dims)))
+        kept = tuple( name for name in self.dims if name not in dims )
+        return gridArray(self.grid, self.quantity, self.index, kept, reduce=(operation, tuple(dims)))
+
+    def sum(self, dims=None): return self._reduce('sum', dims)
+    def mean(self, dims=None): return self._reduce('mean', dims)
+    def min(self, dims=None): return self._reduce('min', dims)
+    def max(self, dims=None): return self._reduce('max', dims)
+
+
+    def _blocks(self):
+        """ (chunk key, positions in the selection, positions in the chunk) for every dimension. """
+        groups = []
+        for index, size in zip(self.index, self.grid.chunks):
+            number = index // size
+            groups.append( [ (k, np.flatnonzero(number == k), index[number == k] - k*size) for k in np.unique(number) ] )
+        for parts in np.ndindex( *[len(g) for g in groups] ):
+            chosen = [ groups[d][p] for d, p in enumerate(parts) ]
+            yield tuple( c[0] for c in chosen ), [c[1] for c in chosen], [c[2] for c in chosen]
+
+
+    @property
+    def values(self):
+        """ Compute (only the chunks that are needed) and return a numpy array. """
+        grid = self.grid
+        full = tuple( len(index) for index in self.index )
+        if self.reduction is None:
+            result = np.empty(full)
+            for key, outer, inner in self._blocks():
+                result[np.ix_(*outer)] = grid.chunk(key)[self.quantity][np.ix_(*inner)]
+            return result.reshape(self.shape)
+
+        operation, dims = self.reduction
+        axes = tuple( grid.dims.index(name) for name in dims )
+        kept = tuple( k for k in range(len(grid.dims)) if k not in axes )
+        combine = {'sum':np.add, 'mean':np.add, 'min':np.minimum, 'max':np.maximum}[operation]
+        start = {'sum':0.0, 'mean':0.0, 'min':np.inf, 'max':-np.inf}[operation]
+        result = np.full( [full[k] for k in kept], start )
+        for key, outer, inner in self._blocks():
+            block = grid.chunk(key)[self.quantity][np.ix_(*inner)]
+            part = {'min':np.min, 'max':np.max}.get(operation, np.sum)(block, axis=axes)
+            target = np.ix_(*[outer[k] for k in kept]) if kept else ()
+            result[target] = combine( result[target], part )
+        if operation == 'mean':
+            result /= np.prod( [full[k] for k in axes] )
+        # dimensions that were dropped by integer selection are length one here
+        return result.reshape( tuple( full[k] for k in kept if grid.dims[k] in self.dims ) )
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cube = gridQuery(epochs=[2010.0, 2015.0], heights=[0.0, 400e3], latitudes=np.arange(-80.0, 81.0, 10.0),
+                              longitudes=np.arange(0.0, 360.0, 15.0), outputs=('F','D'),
+                              chunks={'latitude':5, 'longitude':8})
+
+    def test_lazy(self):
+        cube = self.cube
+        self.assertEqual( cube.shape, (2, 2, 17, 24) )
+        D = cube['D'].sel(epoch=2015, height=0.0, latitude=slice(40, 60), longitude=250.0)
+        self.assertEqual( cube.computed, 0 )   ;# nothing yet
+        self.assertEqual( D.dims, ('latitude',) )
+        self.assertTrue( np.all( D.coords['latitude'] == [40.0, 50.0, 60.0] ) )
+        expect = igrfModel(2015.0).geographic(0.0, np.array([40.0, 50.0, 60.0]), 255.0)['field']['declination']
+        self.assertTrue( np.allclose( D.values, expect ) )
+        self.assertEqual( cube.computed, 1 )   ;# one chunk
+        D.values
+        self.assertEqual( cube.computed, 1 )   ;# cached
+
+    def test_reduce(self):
+        cube = self.cube
+        F = cube['F'].isel(epoch=1)
+        eager = F.values
+        self.assertEqual( eager.shape, (2, 17, 24) )
+        self.assertTrue( np.allclose( F.mean('longitude').values, eager.mean(axis=2) ) )
+        self.assertTrue( np.allclose( F.max(['height', 'latitude']).values, eager.max(axis=(0,1)) ) )
+        self.assertAlmostEqual( float( F.min().values ), eager.min() )
+        self.assertEqual( cube.computed, 2*4*3 )   ;# each chunk of the epoch once
+        self.assertRaises( KeyError, cube.__getitem__, 'I' )
+        self.assertRaises( ValueError, F.sel, epoch=2015 )
+        self.assertRaises( ValueError, gridQuery, [2015.0], [0.0], [0.0], [0.0], outputs=('Q',) )
+        self.assertRaises( ValueError, gridQuery, [2015.0], [0.0], [0.0], [0.0], outputs=('x',) )
+
+if __name__ == "__main__":
+    unittest.main()
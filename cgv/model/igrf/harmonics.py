@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+ harmonics.py
+
+    Spherical harmonic synthesis of any degree from packed coefficients.
+
+    from harmonics import gaussModel
+    model = gaussModel(2015, source='igrf12')      # or any registered source
+    print model.geographic(0.0, 51.0, 246.0, outputs=('F','D'))
+
+    gaussModel has the same interface as igrfModel (spherical, geographic,
+    cartesian, fdi, outputs=...), but instead of dense scipy.special.lpmn
+    matrices it uses the fully normalised Legendre recurrences of Holmes
+    and Featherstone (2002), advancing one degree at a time for all orders
+    and all points at once.  The work per point is O(N^2), memory is O(N)
+    per point, and nothing overflows at high degree (terms near the poles
+    underflow gracefully to zero instead).
+
+    Holmes, S.A. and Featherstone, W.E. (2002), A unified approach to the
+    Clenshaw summation and the recursive computation of very high degree
+    and order normalised associated Legendre functions, J. Geodesy, 76, 279-299
+'''
+
+import time
+import numpy as np
+import unittest
+
+import coefficients
+from igrf_model import igrfModel
+
+
+def legendre(theta, degree):
+    """
+    Generator of fully normalised associated Legendre functions and their
+    theta derivatives for n = 0..degree, each as (n+1, npoints) arrays over
+    order m.  Schmidt semi-normalised values are these divided by sqrt(2n+1).
+    """
+    t, u = np.cos(theta), np.sin(theta)
+    P1 = np.ones( (1,) + np.shape(theta) )   ;# n-1
+    P2 = np.zeros( (0,) + np.shape(theta) )  ;# n-2
+    yield P1, np.zeros_like(P1)
+    for n in range(1, degree+1):
+        m = np.arange(n)[:,None]
+        a = np.sqrt( (2.0*n-1)*(2.0*n+1) / ((n-m)*(n+m)) )
+        P = np.empty( (n+1,) + np.shape(theta) )
+        P[0:n] = a * t * P1
+        if n >= 2:
+            b = np.sqrt( (2.0*n+1)*(n+m[0:n-1]-1)*(n-m[0:n-1]-1) / ((n-m[0:n-1])*(n+m[0:n-1])*(2.0*n-3)) )
+            P[0:n-1] -= b * P2
+        P[n] = u * P1[n-1] * ( np.sqrt(3.0) if n == 1 else np.sqrt( (2.0*n+1) / (2.0*n) ) )
+        f = np.sqrt( (n*n - m*m) * (2.0*n+1) / (2.0*n-1) )
+        dP = n * t * P
+        dP[0:n] -= f * P1
+        dP /= u
+        yield P, dP
+        P2, P1 = P1, P
+
+
+def synthesize(g, h, degree, r, theta, phi, radius=6371.2e3, need=('r','theta','phi')):
+    """
+    Field components [nT] (and potential V [nT m]) at arrays of spherical
+    positions from packed Schmidt semi-normalised coefficients g, h.
+    """
+    n, m = coefficients.degrees(degree)
+    scale = 1.0 / np.sqrt(2.0*n + 1)   ;# fully normalised -> Schmidt
+    g, h = np.asarray(g[0:len(n)]) * scale, np.asarray(h[0:len(n)]) * scale
+
+    rr = radius / r
+    mphi = np.arange(degree+1)[:,None] * phi
+    cphi, sphi = np.cos(mphi), np.sin(mphi)   ;# (degree+1, npoints)
+    field = dict( (name, np.zeros(np.shape(r))) for name in need if name in ('r','theta','phi','V') )
+    rn = rr * rr   ;# (a/r)^(n+2) for n=0
+    for k, (P, dP) in enumerate( legendre(theta, degree) ):
+        sl = slice( coefficients.index(k,0), coefficients.index(k,k)+1 )
+        G, H = g[sl,None], h[sl,None]
+        if 'r' in field or 'V' in field or 'theta' in field:
+            A = G*cphi[0:k+1] + H*sphi[0:k+1]
+            if 'r' in field or 'V' in field:
+                s = np.sum(A*P, axis=0)
+                if 'r' in field: field['r'] += (k+1) * rn * s
+                if 'V' in field: field['V'] += radius * rn / rr * s
+            if 'theta' in field:
+                field['theta'] -= rn * np.sum(A*dP, axis=0)
+        if 'phi' in field:
+            mm = np.arange(k+1)[:,None]
+            field['phi'] -= rn * np.sum( mm * (-G*sphi[0:k+1] + H*cphi[0:k+1]) * P, axis=0 )
+        rn = rn * rr
+    if 'phi' in field: field['phi'] /= np.sin(theta)
+    return field
+
+
+class gaussModel(igrfModel):
+    """
+    Spherical harmonic model of arbitrary degree from a registered
+    coefficient source, with packed triangular coefficient storage.
+    Only the coordinate and output handling of igrfModel is shared; its
+    dense [m,n] coefficient methods are not available here.
+    """
+
+    chunk = 2**20   ;# (degree+1) x points per block, bounds temporary memory
+
+    def _dense(self, *args, **kwargs):
+        raise NotImplementedError('gaussModel has packed coefficients g, h instead of dense gcoeff, hcoeff; use spherical()')
+
+    _spherical0 = _spherical1 = _spherical2 = _spherical3 = _spherical_array = _dense
+    _legendre = cached_coefficients = read_coefficients = _dense
+
+    def __init__(self, year=None, verbose=0, degree=None, dtype='float', source='igrf12'):
+        self.verbose = verbose
+        self.source = source
+        self.coefficients = coefficients.load(source)
+        self.Re = self.coefficients.radius
+        self.degree = self.coefficients.degree if degree is None else min(degree, self.coefficients.degree)
+        self.dtype = np.dtype(dtype).str
+        self.set_year(year)
+
+
+    def set_year(self, year=None):
+        if year is None:
+            year = time.gmtime()[0]  ;# today
+            if self.verbose: print("Using today's date: %s" % year)
+        self.year = year
+        self.coefficients = coefficients.load(self.source)   ;# follows coefficients.register()
+        g, h = self.coefficients.at(year)
+        self.g, self.h = g.astype(self.dtype), h.astype(self.dtype)   ;# packed, Schmidt semi-normalised
+
+
+    def dipole(self):
+        g10, g11, h11 = self.g[1], self.g[2], self.h[2]
+        return {'g10':g10, 'g11':g11, 'h11':h11, 'B0':np.sqrt( g10**2 + g11**2 + h11**2 )}
+
+
+    def spherical(self, r=None, theta=None, phi=None, degree=None, potential=False, metadata=True, outputs=None, **kwargs):
+        """
+        Model magnetic field vector in spherical coordinates, as for
+        igrfModel.spherical(), for scalars or arrays of positions.
+        """
+        if degree is None: degree = self.degree
+        theta = np.clip(theta, 1.0e-6, np.pi-1.0e-6)   # avoid singularity at poles
+        need = self._outputs( ('r','theta','phi') if outputs is None else outputs, potential, 'spherical' )
+
+        r_, theta_, phi_ = np.broadcast_arrays( np.asarray(r, dtype='float'), theta, phi )
+        shape = r_.shape
+        r_, theta_, phi_ = r_.ravel(), theta_.ravel(), phi_.ravel()
+        names = [name for name in ['r','theta','phi','V'] if name in need]
+        field = dict( (name, np.empty(r_.size)) for name in names )
+        block = max(1, self.chunk // (degree+1))
+        for start in range(0, r_.size, block):
+            s = slice(start, start+block)
+            part = synthesize(self.g, self.h, degree, np.abs(r_[s]), theta_[s], phi_[s], radius=self.Re, need=names)
+            for name in names: field[name][s] = part[name]
+        for name in names: field[name] = field[name].reshape(shape) if shape else field[name][0]
+
+        result = {'field':field}
+        if (metadata):
+            result.update( {'position':{'r':r, 'theta':theta, 'phi':phi}} )
+            result.update( {'_':{'name':'%s magnetic field model' % self.coefficients.name, 'units':'nanoTesla', 'year':self.year}} )
+        return result
+
+
+    def to_bytes(self):
+        """ Compact binary copy: source name, year, degree, dtype and the packed g, h. """
+        name = self.source.encode('ascii')
+        dtype = np.dtype(self.dtype).newbyteorder('<')
+        header = self._header.pack(b'GAUS', 1, len(name), self.year, self.degree, dtype.str.encode('ascii'))
+        k = coefficients.size(self.degree)
+        return header + name + self.g[0:k].astype(dtype).tobytes() + self.h[0:k].astype(dtype).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, length, year, degree, dtype = cls._header.unpack( data[0:cls._header.size] )
+        if magic != b'GAUS' or version != 1:
+            raise ValueError('not a gaussModel byte string')
+        offset = cls._header.size + length
+        self = cls.__new__(cls)
+        self.verbose, self.year, self.degree = 0, year, degree
+        self.source = data[cls._header.size:offset].decode('ascii')
+        self.dtype = dtype.decode('ascii').rstrip('\x00')
+        self.coefficients = coefficients.load(self.source)
+        self.Re = self.coefficients.radius
+        values = np.frombuffer(data, dtype=self.dtype, offset=offset)
+        self.g, self.h = np.split(values.copy(), 2)
+        return self
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def test_legendre(self):
+        # Schmidt semi-normalised values against scipy for moderate degree
+        import scipy.special as spFunc
+        theta = np.array([0.3, 1.2, 2.9])
+        for n, (P, dP) in enumerate( legendre(theta, 20) ):
+            if n not in (0, 1, 7, 20): continue
+            for m in sorted( set([0, 1, n//2, n]) & set(range(n+1)) ):
+                norm = np.sqrt( (2.0 - (m==0)) * np.exp( spFunc.gammaln(n-m+1) - spFunc.gammaln(n+m+1) ) )
+                expect = norm * (-1)**m * spFunc.lpmv(m, n, np.cos(theta))
+                self.assertTrue( np.allclose( P[m] / np.sqrt(2*n+1), expect, rtol=1e-10, atol=1e-14 ) )
+
+    def test_igrf(self):
+        # same answer as the dense lpmn implementation
+        igrf, gauss = igrfModel(2012.3), gaussModel(2012.3, source='igrf12')
+        lat, lon, height = np.array([-80.0, 0.0, 51.0]), np.array([10.0, 0.0, 123.0]), np.array([1e5, 0.0, 9876.0])
+        a = igrf.geographic(height, lat, lon, potential=True)['field']
+        b = gauss.geographic(height, lat, lon, potential=True)['field']
+        for name in ['north', 'east', 'up', 'V']:
+            self.assertTrue( np.allclose( a[name], b[name], rtol=1e-10, atol=1e-6 ) )
+        self.assertAlmostEqual( gauss.spherical(7e6, 1.0, 2.0)['field']['r'], igrf.spherical(7e6, 1.0, 2.0)['field']['r'] )
+
+    def test_high_degree(self):
+        # random degree 300 model: field must be minus the gradient of the potential
+        degree = 300
+        n, m = coefficients.degrees(degree)
+        random = np.random.RandomState(0)
+        g, h = random.normal(size=(2, len(n))) * 1e4 * 0.8**n
+        h[m == 0] = 0.0
+        coefficients.register('random', lambda: coefficients.gaussCoefficients('random', [2000.0], g, h))
+        model = gaussModel(2000.0, source='random')
+        r, theta, phi, d = 6.5e6, 1.1, 0.7, 1e-6
+        b = model.spherical(r, theta, phi, potential=True)['field']
+        self.assertTrue( np.all( np.isfinite( [b['r'], b['theta'], b['phi'], b['V']] ) ) )
+        V = lambda r, theta, phi: model.spherical(r, theta, phi, outputs=('V',))['field']['V']
+        Br = -( V(r*(1+d), theta, phi) - V(r*(1-d), theta, phi) ) / (2*r*d)
+        Bt = -( V(r, theta+d, phi) - V(r, theta-d, phi) ) / (2*d*r)
+        Bp = -( V(r, theta, phi+d) - V(r, theta, phi-d) ) / (2*d*r*np.sin(theta))
+        self.assertTrue( np.allclose( [b['r'], b['theta'], b['phi']], [Br, Bt, Bp], rtol=1e-5 ) )
+
+    def test_dense(self):
+        # igrfModel's dense coefficient methods fail clearly instead of with AttributeError
+        model = gaussModel(2015.0)
+        self.assertRaises( NotImplementedError, model._spherical1, 7e6, 1.0, 2.0 )
+        self.assertRaises( NotImplementedError, model._spherical_array, 7e6, [1.0, 1.1], 2.0 )
+        self.assertRaises( NotImplementedError, model.cached_coefficients )
+
+    def test_bytes(self):
+        model = gaussModel(2011.5, dtype='float32')
+        copy = gaussModel.from_bytes( model.to_bytes() )
+        self.assertEqual( copy.source, 'igrf12' )
+        self.assertAlmostEqual( copy.geographic(0.0, 45.0, 45.0)['field']['up'],
+                                model.geographic(0.0, 45.0, 45.0)['field']['up'], places=6 )
+
+if __name__ == "__main__":
+    unittest.main()
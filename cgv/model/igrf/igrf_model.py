@@ -30,10 +30,12 @@ import numpy as np
 #import numexpr as ne  # doesn't provide any speed gain
 import scipy
 import scipy.special as spFunc
-import scipy.misc as spMisc
 import time
+import struct
 import unittest
 
+import coefficients
+
 
 class igrfModel(object):
     """
@@ -49,6 +51,8 @@ class igrfModel(object):
     dtor = np.double(np.pi)/180.0
     Re = np.double(6371.20e3)   ;# Earth radius in metres
     coefficients = {}  ;# all model coefficients (at end of this file)
+    source = 'igrf12'  ;# name of the coefficient source, see coefficients.py
+    _cache = {}        ;# source name -> (loaded coefficients, dense table made from them)
 
     # WGS-84 geoid parameters
     #
@@ -59,17 +63,39 @@ class igrfModel(object):
     b2= 40408296.0e6   ;# b^2
 
 
-    def __init__(self, year=None, verbose=0):
+    def __init__(self, year=None, verbose=0, degree=14, dtype='float', source=None):
         self.verbose = verbose
-        self.coefficients = self.read_coefficients()
+        if source is not None: self.source = source
+        self.degree = degree  ;# default maximum degree used by spherical()
+        self.dtype = np.dtype(dtype).str  ;# eg. '<f4' for compact float32 coefficients
+        self.coefficients = self.cached_coefficients()
         self.set_year(year)
 
+    def cached_coefficients(self):
+        """
+        Dense coefficient table, made once from each coefficients.load() and
+        shared between instances, so that it follows coefficients.register().
+        """
+        source = coefficients.load(self.source)
+        if self._cache.get(self.source, (None,))[0] is not source:
+            self._cache[self.source] = (source, self.read_coefficients())
+        return self._cache[self.source][1]
+
+    def __reduce__(self):
+        """
+        Pickle as a small token that is rehydrated from the coefficient cache
+        of the receiving process, instead of the full coefficient tables.
+        Note that any direct modification of gcoeff/hcoeff is not preserved.
+        """
+        return (_rehydrate, (self.__class__, self.source, self.year, self.degree, self.dtype, self.verbose))
+
     # coefficients = self.read_coefficients(coeff)  # at end of file after data
     # cache coefficients and preliminary calculations
     mm = np.arange(15)
     nn = np.arange(15)
     n2, m2 = np.meshgrid(mm,nn)
-    schmidt_norm = np.sqrt((2.0-1*(m2==0)) * spMisc.factorial(n2-m2) / spMisc.factorial(n2+m2))  * (-1)**m2
+    # (n-m)!/(n+m)! via log gamma, since the factorials overflow for large n
+    schmidt_norm = np.sqrt((2.0-1*(m2==0)) * np.exp( spFunc.gammaln(np.maximum(n2-m2,0)+1) - spFunc.gammaln(n2+m2+1) ))  * (-1)**m2
 
     """ FIXME: allow arbitrary year """
     def set_year(self, year=None):
@@ -79,10 +105,11 @@ class igrfModel(object):
 #        year = np.array(year) #.astype(int)
 
         self.year = year
+        self.coefficients = self.cached_coefficients()
         yearlist = np.array( sorted(  self.coefficients.keys() ) ) #; print(year,yearlist)
-        if year in yearlist:
-            self.gcoeff = self.coefficients[year]['g']
-            self.hcoeff = self.coefficients[year]['h']
+        if year in yearlist:  # copy, the table is shared with other instances
+            self.gcoeff = self.coefficients[year]['g'].copy()
+            self.hcoeff = self.coefficients[year]['h'].copy()
         else:
             year = np.clip(year, np.min(yearlist), np.max(yearlist) )
             y0 = yearlist[yearlist<=year]
@@ -94,8 +121,49 @@ class igrfModel(object):
             self.gcoeff = c0['g'] + dy*( c1['g'] - c0['g'] )
             self.hcoeff = c0['h'] + dy*( c1['h'] - c0['h'] )
 
-        self.gcoeff *= self.schmidt_norm
-        self.hcoeff *= self.schmidt_norm
+        self.gcoeff = (self.gcoeff * self.schmidt_norm).astype(self.dtype)
+        self.hcoeff = (self.hcoeff * self.schmidt_norm).astype(self.dtype)
+	#-------------------------------------------------------
+
+
+    _header = struct.Struct('<4sBHdH4s')   ;# magic, version, length of source name, year, degree, dtype
+
+    def to_bytes(self):
+        """
+        Compact binary copy of the normalised coefficients for the current
+        year: a 21 byte header and the coefficient source name, followed by
+        the triangular (m<=n) part of g and h up to self.degree, in the
+        instance dtype.
+        """
+        m, n = self.m2[0:self.degree+1,0:self.degree+1], self.n2[0:self.degree+1,0:self.degree+1]
+        lower = m <= n
+        name = self.source.encode('ascii')
+        dtype = np.dtype(self.dtype).newbyteorder('<')
+        header = self._header.pack(b'IGRF', 1, len(name), self.year, self.degree, dtype.str.encode('ascii'))
+        return header + name + self.gcoeff[m[lower],n[lower]].astype(dtype).tobytes() \
+                             + self.hcoeff[m[lower],n[lower]].astype(dtype).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Model from the output of to_bytes().  The coefficient table is only
+        read if set_year() is later called to change epochs.
+        """
+        magic, version, length, year, degree, dtype = cls._header.unpack( data[0:cls._header.size] )
+        if magic != b'IGRF' or version != 1:
+            raise ValueError('not an igrfModel byte string')
+        self = cls.__new__(cls)
+        self.verbose, self.year, self.degree = 0, year, degree
+        offset = cls._header.size + length
+        self.source = data[cls._header.size:offset].decode('ascii')
+        self.dtype = dtype.decode('ascii').rstrip('\x00')
+        m, n = self.m2[0:degree+1,0:degree+1], self.n2[0:degree+1,0:degree+1]
+        lower = m <= n
+        values = np.frombuffer(data, dtype=self.dtype, offset=offset)
+        self.gcoeff = np.zeros(self.m2.shape, dtype=self.dtype) ; self.gcoeff[m[lower],n[lower]] = values[0:lower.sum()]
+        self.hcoeff = np.zeros(self.m2.shape, dtype=self.dtype) ; self.hcoeff[m[lower],n[lower]] = values[lower.sum():]
+        self.coefficients = {}  ;# read by set_year() if needed
+        return self
 	#-------------------------------------------------------
 
 
@@ -191,12 +259,48 @@ class igrfModel(object):
 	#-------------------------------------------------------
 
 
-    def spherical(self, r=None, theta=None, phi=None, degree=14, potential=False, metadata=True, **kwargs):
+    # Names accepted by outputs=(...) and the quantities each one is calculated from.
+    aliases = {'F':'field', 'H':'horizontal', 'D':'declination', 'I':'inclination', 'potential':'V'}
+    depends = {'r':[], 'theta':[], 'phi':[], 'V':[],
+               'north':['r','theta'], 'up':['r','theta'], 'east':['phi'],
+               'x':['r','theta','phi'], 'y':['r','theta','phi'], 'z':['r','theta'],
+               'horizontal':['north','east'], 'declination':['north','east'],
+               'inclination':['up','horizontal'], 'field':['north','east','up']}
+    # Names that each of spherical(), cartesian() and geographic() can return.
+    provides = {'spherical':['r','theta','phi','V'],
+                'cartesian':['r','theta','phi','V','x','y','z'],
+                'geographic':['r','theta','phi','V','north','east','up',
+                              'field','horizontal','declination','inclination']}
+
+    def _outputs(self, outputs, potential=False, system='geographic'):
+        """
+        Expand a list of requested outputs to everything that must be
+        calculated, rejecting names that the coordinate system can not provide.
+        """
+        names = [self.aliases.get(name, name) for name in outputs] + (['V'] if potential else [])
+        valid = self.provides[system]
+        for name in names:
+            if name not in valid:
+                raise ValueError('unknown %s output %s, expected one of %s' % (system, name,
+                                 sorted(valid) + sorted(a for a in self.aliases if self.aliases[a] in valid)))
+        need = set()
+        while names:
+            name = names.pop()
+            if name not in need:
+                need.add(name) ; names.extend( self.depends[name] )
+        return need
+	#-------------------------------------------------------
+
+
+    def spherical(self, r=None, theta=None, phi=None, degree=None, potential=False, metadata=True, outputs=None, **kwargs):
         """
         IGRF model magnetic field vector expressed in spherical coordinates:
             radius from center of the earth [metres]
             colatitude from North pole [degrees]
             longitude from Greenwich [degrees] east
+
+        outputs=('r','V') limits the calculation to those components
+        (default r, theta, phi, plus V if potential=True).
         """
         """
         Core calculation.  Express inner sum as matrix multiplication np.dot()
@@ -204,39 +308,52 @@ class igrfModel(object):
         """
         # this version takes 100us - my IDL code takes 120us for all 3 components
 
+        if degree is None: degree = self.degree
         theta = np.clip(theta, 1.0e-6, np.pi-1.0e-6)   # avoid singularity at poles
+        need = self._outputs( ('r','theta','phi') if outputs is None else outputs, potential, 'spherical' )
+        if np.ndim(r) or np.ndim(theta) or np.ndim(phi):   # arrays of positions
+            result = {'field':self._spherical_array(r, theta, phi, degree=degree, need=need)}
+            if (metadata):
+                result.update( {'position':{'r':r, 'theta':theta, 'phi':phi}} )
+                result.update( {'_':{'name':'IGRF magnetic field model', 'units':'nanoTesla',  'year':self.year}} )
+            return result
+
         field = {}   ;# returning a collection of components is faster than forming an array
 
         # Use scipy library routine to do all the hard work of calculating
         # an array of Legendre polynomials and their derivatives.
         #
         Pmn, dPmn = spFunc.lpmn( n=degree, m=degree, z=np.cos(theta) )
-        dPmn *= -1*np.sin(theta)  ;# from d/dz to d/dtheta
         # need to schmidt normalize, but more efficient to do once on coefficients
         #Pmn *= schmidt_norm  # could pre-multiply coefficients
         #dPmn *= schmidt_norm  # could pre-multiply coefficients
 
         gg, hh = self.gcoeff[0:degree+1,0:degree+1], self.hcoeff[0:degree+1,0:degree+1]  # 5us
-        Gmn, Hmn = gg * Pmn , hh * Pmn # 10 us
+        if need & set(['r','V','phi']):
+            Gmn, Hmn = gg * Pmn , hh * Pmn # 10 us
 
         nn, mm = self.nn[0:degree+1], self.mm[0:degree+1]  # 1us
         rradius = np.abs(self.Re/r) ; rfactor = rradius**(nn+2)  # 9us
         mmphi = mm*phi ; cphi, sphi = np.cos(mmphi) , np.sin(mmphi)  ;# 14us
 
-        # sum over M by multiplying a matrix and column vector
-        msum = Gmn.T.dot( cphi ) + Hmn.T.dot( sphi )    ;# 9 us
-
-        if (potential): #!! fixme !!  optimize radius calculation?
-            field.update(V = self.Re * msum.dot( rfactor / rradius ))  # 9us of 150us
+        if need & set(['r','V']):
+            # sum over M by multiplying a matrix and column vector
+            msum = Gmn.T.dot( cphi ) + Hmn.T.dot( sphi )    ;# 9 us
 
-        field.update( r = msum.dot( (nn+1)*rfactor ) )  ;# 11 us
+            if 'V' in need: #!! fixme !!  optimize radius calculation?
+                field.update(V = self.Re * msum.dot( rfactor / rradius ))  # 9us of 150us
+            if 'r' in need:
+                field.update( r = msum.dot( (nn+1)*rfactor ) )  ;# 11 us
 
-        msum = -Gmn.T.dot( mm*sphi ) + Hmn.T.dot( mm*cphi )
-        field.update( phi = -msum.dot( rfactor ) / np.sin(theta) )
+        if 'phi' in need:
+            msum = -Gmn.T.dot( mm*sphi ) + Hmn.T.dot( mm*cphi )
+            field.update( phi = -msum.dot( rfactor ) / np.sin(theta) )
 
-#       Gmn, Hmn = gg * dPmn , hh * dPmn  ; msum = Gmn.T.dot( cphi ) + Hmn.T.dot( sphi )
-        msum = (gg*dPmn).T.dot( cphi ) + (hh*dPmn).T.dot( sphi )  ;# not actually faster
-        field.update( theta = -msum.dot( rfactor )  )
+        if 'theta' in need:
+            dPmn *= -1*np.sin(theta)  ;# from d/dz to d/dtheta
+#           Gmn, Hmn = gg * dPmn , hh * dPmn  ; msum = Gmn.T.dot( cphi ) + Hmn.T.dot( sphi )
+            msum = (gg*dPmn).T.dot( cphi ) + (hh*dPmn).T.dot( sphi )  ;# not actually faster
+            field.update( theta = -msum.dot( rfactor )  )
 
         result = {'field':field}
         if (metadata):
@@ -247,13 +364,83 @@ class igrfModel(object):
 	#-------------------------------------------------------
 
 
+    chunk = 4096  ;# points per block in vectorized calculations, bounds temporary memory
+
+    def _spherical_array(self, r, theta, phi, degree=14, need=('r','theta','phi')):
+        """
+        Vectorized version of the core calculation for arrays of positions,
+        in blocks of self.chunk points.  Within each block the Legendre
+        functions are evaluated once per unique colatitude (ie. once per row
+        of a latitude/longitude grid, or once per point for scattered
+        positions) with a recurrence that is vectorized over all of them,
+        then contracted with the radial and longitude factors.  Temporary
+        memory is therefore bounded by the block size.  Only the components
+        listed in need are calculated.
+        """
+        r, theta, phi = np.broadcast_arrays( np.asarray(r, dtype='float'), theta, phi )
+        shape = r.shape
+        r, theta, phi = r.ravel(), theta.ravel(), phi.ravel()
+
+        gg, hh = self.gcoeff[0:degree+1,0:degree+1], self.hcoeff[0:degree+1,0:degree+1]
+        nn, mm = self.nn[0:degree+1], self.mm[0:degree+1]
+
+        names = [name for name in ['r','theta','phi','V'] if name in need]
+        field = dict( (name, np.empty(r.size)) for name in names )
+        for start in range(0, r.size, self.chunk):
+            s = slice(start, start+self.chunk)
+            utheta, k = np.unique(theta[s], return_inverse=True)
+            Pmn, dPmn = self._legendre(utheta, degree)
+            Gmn, Hmn = gg*Pmn, hh*Pmn
+            if 'theta' in need: dGmn, dHmn = gg*dPmn, hh*dPmn
+            rradius = np.abs(self.Re/r[s]) ; rfactor = rradius[:,None]**(nn+2)
+            mmphi = phi[s,None]*mm ; cphi, sphi = np.cos(mmphi) , np.sin(mmphi)
+
+            if 'r' in field or 'V' in field:
+                # sum over M for every point, leaving one row of N terms per point
+                msum = np.einsum('pmn,pm->pn', Gmn[k], cphi) + np.einsum('pmn,pm->pn', Hmn[k], sphi)
+                if 'V' in field:
+                    field['V'][s] = self.Re * np.sum( msum * rfactor / rradius[:,None], axis=1 )
+                if 'r' in field:
+                    field['r'][s] = np.sum( msum * (nn+1)*rfactor, axis=1 )
+
+            if 'phi' in field:
+                msum = -np.einsum('pmn,pm->pn', Gmn[k], mm*sphi) + np.einsum('pmn,pm->pn', Hmn[k], mm*cphi)
+                field['phi'][s] = -np.sum( msum * rfactor, axis=1 ) / np.sin(theta[s])
+
+            if 'theta' in field:
+                msum = np.einsum('pmn,pm->pn', dGmn[k], cphi) + np.einsum('pmn,pm->pn', dHmn[k], sphi)
+                field['theta'][s] = -np.sum( msum * rfactor, axis=1 )
+
+        for name in names: field[name] = field[name].reshape(shape)
+        return field
+	#-------------------------------------------------------
+
+
+    def _legendre(self, theta, degree):
+        """
+        Legendre functions and their theta derivatives as [point,m,n] arrays
+        in the scipy.special.lpmn convention (to match schmidt_norm), for an
+        array of colatitudes, from the recurrence in harmonics.legendre().
+        """
+        from harmonics import legendre
+        Pmn = np.zeros( [len(theta), degree+1, degree+1] )  ;  dPmn = np.zeros_like(Pmn)
+        norm = self.schmidt_norm
+        for n, (P, dP) in enumerate( legendre(theta, degree) ):
+            scale = 1.0 / ( np.sqrt(2.0*n + 1) * norm[0:n+1,n] )   ;# fully normalised -> lpmn
+            Pmn[:,0:n+1,n] = (P * scale[:,None]).T
+            dPmn[:,0:n+1,n] = (dP * scale[:,None]).T
+        return Pmn, dPmn
+	#-------------------------------------------------------
 
 
-    def geographic(self, height=None, latitude=None, longitude=None, metadata=True, potential=False, **kwargs):
+    def geographic(self, height=None, latitude=None, longitude=None, metadata=True, potential=False, outputs=None, **kwargs):
         """
         IGRF model magnetic field vector expressed in geographic (geodetic)
         coordinates: local East, North, Up (ENU).  Input height in metres above
         mean sea level, latitude in degrees North, longitude in degrees East.
+
+        outputs=('F','D') calculates only those quantities (and whatever they
+        depend on); the default is every vector component and F, H, D, I.
         """
 #        # WGS-84
 #        a2= 40680631.6e6   ;# a^2
@@ -269,21 +456,29 @@ class igrfModel(object):
 #        r= (N+height) * calpha / np.cos(betaa)  #;Distance from the centre of the earth, metres
 #        psi = alpha-betaa
 
+        if outputs is None:
+            outputs = ['east','north','up','field','horizontal','declination','inclination']
+        need = self._outputs(outputs, potential)
         coords = self.convert_coordinates(height=height, latitude=latitude, longitude=longitude, **kwargs)
-        result = self.spherical(r=coords['r'], theta=coords['theta'], phi=coords['phi'], potential=potential)
+        result = self.spherical(r=coords['r'], theta=coords['theta'], phi=coords['phi'],
+                                outputs=need & set(['r','theta','phi','V']))
         psi = coords.get('psi',0.0)
-        north = -result['field']['theta'] * np.cos(psi) - result['field']['r'] * np.sin(psi)
-        east = result['field']['phi']
-        down = result['field']['theta'] * np.sin(psi) - result['field']['r'] * np.cos(psi)
-        result['field'].update( dict( east=east, north=north, up=-down) )
-
         b = result['field']   #;  print q
-        b = np.array( [ b['north'], b['east'], b['up'] ] )
-        field = np.sqrt( b[0]**2 + b[1]**2 + b[2]**2 )
-        horizontal = np.sqrt( b[0]**2 + b[1]**2 )
-        declination = np.arctan2( b[1], b[0] ) / self.dtor
-        inclination = np.arctan2( b[2], horizontal ) / self.dtor
-        result['field'].update( {'inclination':inclination, 'declination':declination, 'horizontal':horizontal, 'field':field} )
+        if 'north' in need:
+            b['north'] = -b['theta'] * np.cos(psi) - b['r'] * np.sin(psi)
+        if 'east' in need:
+            b['east'] = b['phi']
+        if 'up' in need:
+            b['up'] = -( b['theta'] * np.sin(psi) - b['r'] * np.cos(psi) )
+
+        if 'field' in need:
+            b['field'] = np.sqrt( b['north']**2 + b['east']**2 + b['up']**2 )
+        if 'horizontal' in need:
+            b['horizontal'] = np.sqrt( b['north']**2 + b['east']**2 )
+        if 'declination' in need:
+            b['declination'] = np.arctan2( b['east'], b['north'] ) / self.dtor
+        if 'inclination' in need:
+            b['inclination'] = np.arctan2( b['up'], b['horizontal'] ) / self.dtor
 
         if (metadata):
             result['position'].update( {'height':height, 'latitude':latitude, 'longitude':longitude} )
@@ -292,33 +487,51 @@ class igrfModel(object):
         ########################################################################
 
 
-    def cartesian(self, x=None, y=None, z=None, metadata=True, potential=False, **kwargs): #pass
+    def cartesian(self, x=None, y=None, z=None, metadata=True, potential=False, outputs=None, **kwargs): #pass
+        """
+        Field in geocentric cartesian components at (x, y, z) [metres].
+        outputs=('x','y','z') limits the calculation to those components
+        (default r, theta, phi and x, y, z, plus V if potential=True).
+        """
 #        r = np.sqrt( x*x + y*y + z*z)
 #        theta = np.arccos( z/r )
 #        phi = np.arctan2(y,x)
+        need = self._outputs( ('r','theta','phi','x','y','z') if outputs is None else outputs, potential, 'cartesian' )
         coords = self.convert_coordinates(x=x, y=y, z=z, **kwargs)
-        result = self.spherical(r=coords['r'], theta=coords['theta'], phi=coords['phi'], potential=potential)
+        result = self.spherical(r=coords['r'], theta=coords['theta'], phi=coords['phi'], metadata=metadata,
+                                outputs=need & set(['r','theta','phi','V']))
 #        result = self.spherical( r=r, theta=theta, phi=phi, metadata=metadata, potential=potential )
-        bx = result['field']['r'] * np.sin( result['field']['theta'] ) * np.cos( result['field']['phi'] )
-        by = result['field']['r'] * np.sin( result['field']['theta'] ) * np.sin( result['field']['phi'] )
-        bz = result['field']['r'] * np.cos( result['field']['theta'] )
-        result['field'].update( dict(x=bx, y=by, z=bz) )
+        # rotate vector components from local (r, theta, phi) unit vectors to (x, y, z)
+        b = result['field']
+        st, ct = np.sin( coords['theta'] ), np.cos( coords['theta'] )
+        sp, cp = np.sin( coords['phi'] ), np.cos( coords['phi'] )
+        if 'x' in need: b['x'] = ( b['r'] * st + b['theta'] * ct ) * cp - b['phi'] * sp
+        if 'y' in need: b['y'] = ( b['r'] * st + b['theta'] * ct ) * sp + b['phi'] * cp
+        if 'z' in need: b['z'] = b['r'] * ct - b['theta'] * st
         if metadata:
             result['position'].update( dict( x=x, y=y, z=z ) )
         return result
 	#-------------------------------------------------------
 
 
+    def dipole(self):
+        """
+        Dipole (degree 1) coefficients g10, g11, h11 in nanoTesla and the
+        dipole field strength at the reference radius B0=sqrt(g10^2+g11^2+h11^2)
+        """
+        g = self.gcoeff[0:2,1] / self.schmidt_norm[0:2,1]  ;# undo normalization
+        h = self.hcoeff[0:2,1] / self.schmidt_norm[0:2,1]
+        return {'g10':g[0], 'g11':g[1], 'h11':h[1], 'B0':np.sqrt( g[0]**2 + g[1]**2 + h[1]**2 )}
+	#-------------------------------------------------------
+
+
     def fdi(self,**kwargs):
-        coords = self.convert_coordinates(**kwargs)
-        result = self.geographic(**coords)
-        b = result['field']   #;  print q
-        b = np.array( [ b['x'], b['y'], b['z'] ] )
-        field = np.sqrt( b[0]**2 + b[1]**2 + b[2]**2 )
-        horizontal = np.sqrt( b[0]**2 + b[1]**2 )
-        declination = np.arctan2( b[1], b[0] ) / self.dtor
-        inclination = np.arctan2( b[2], horizontal ) / self.dtor
-        result['field'].update( {'inclination':inclination, 'declination':declination, 'horizontal':horizontal, 'field':field} )
+        """
+        Total field, declination and inclination (plus horizontal intensity)
+        at any position accepted by convert_coordinates().  Vector directions
+        are geodetic for (height, latitude, longitude) and geocentric otherwise.
+        """
+        return self.geographic(outputs=('F','D','I','H'), **kwargs)
 	#-------------------------------------------------------
 
 
@@ -383,8 +596,8 @@ class igrfModel(object):
 
  #   def trace(height, latitude, longitude, terminate:{'height':900e3}): pass    # field-line tracer
  #   def AACGM(): pass
- #   def Hapgood_coefficients(): pass
- #   def EDFL(): pass
+ #   def Hapgood_coefficients(): pass    # see transforms.py for GEO, GEI, GSE, GSM and SM
+ #   def EDFL(): pass    # see lshell.py for McIlwain L and invariant latitude
 
 # %timeit Pnm0, dPnm0 = scipy.special.lpmn(n=11,m=11,z=0.1)
 # 100000 loops, best of 3: 17.8 µs per loop
@@ -397,7 +610,7 @@ class igrfModel(object):
 #
 # 26 October 2014 - https://www.ngdc.noaa.gov/IAGA/vmod/igrf11coeffs.txt
 #
-    coeff = '''
+    coeff11 = '''
 # 11th Generation International Geomagnetic Reference Field Schmidt semi-normalised spherical harmonic coefficients, degree n=1,13
 # in units nanoTesla for IGRF and definitive DGRF main-field models (degree n=1,8 nanoTesla/year for secular variation (SV))
          IGRF   IGRF   IGRF   IGRF   IGRF   IGRF   IGRF   IGRF   IGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF   DGRF     DGRF      DGRF     IGRF    SV
@@ -802,34 +1015,30 @@ g 13 13      0      0      0      0      0      0      0      0      0      0
 h 13 13      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0      0     -0.9     -0.82     -0.79     -0.8     0.0
     '''
 
-    def read_coefficients(self, name=coeff):
+    def read_coefficients(self, name=None):
         """
-        !!FIXME!!  This code is fragile and should be made more robust.
+        Coefficient table of a registered source (default self.source) as
+        {year: {'g':matrix, 'h':matrix}} with [m,n] indexing.  Models above
+        degree 14 need harmonics.gaussModel instead.
         """
-        c = {}  ;  mat = np.zeros([15,15], dtype='float')
-        lines = self.coeff.split('\n')
-        years = lines[4].split()[3:]
-        years[-1] = years[-1].replace('2010-15','2015.0')  # this will fail in 2015  (and did)
-        years[-1] = years[-1].replace('2015-20','2020.0')  # this will fail in 2020
-#        print(years)
-        years = np.array(years).astype('float')
-        for year in years.astype('int'):
-            c[year] = {'g':mat.copy(), 'h':mat.copy()}
-
-        for line in lines[5:]:
-            parts = line.split()
-            if len(parts) <= 1: continue
-            gh = parts[0]
-            n, m = int(parts[1]), int(parts[2])
-            val = np.array(parts[3:], dtype='float')
-            for indx, year in enumerate(years.astype('int')):
-                c[year][gh][m,n] = val[indx]
+        source = coefficients.load(self.source if name is None else name)
+        if source.degree >= len(self.nn):
+            raise ValueError('%s is degree %d, igrfModel is limited to %d; use harmonics.gaussModel'
+                             % (source.name, source.degree, len(self.nn)-1))
+        c = {}
+        for k, year in enumerate(source.epochs):
+            c[year] = {'g':source.dense(source.g[k], self.m2.shape), 'h':source.dense(source.h[k], self.m2.shape)}
+        return c
 
-        #
-        for gh in ['g','h']: c[years[-1]][gh] += c[years[-2]][gh]
 
-        return c
-            #print year,gh,n,m, indx,val[indx]
+def _rehydrate(cls, source, year, degree, dtype, verbose):
+    """ Inverse of igrfModel.__reduce__() """
+    return cls(year, verbose=verbose, degree=degree, dtype=dtype, source=source)
+
+
+coefficients.register('igrf11', lambda: coefficients.parse_igrf(igrfModel.coeff11, 'igrf11'))
+coefficients.register('igrf12', lambda: coefficients.parse_igrf(igrfModel.coeff, 'igrf12'))
+
 '''
     def odeint_func(self, xyz, t, *args):
         b = self.spherical(xyz[0], xyz[1], xyz[2])  ;# r, theta, phi
@@ -869,6 +1078,43 @@ class BasicTest(unittest.TestCase):
         obj = igrfModel(1899)
         obj = igrfModel(2016)
 
+    def test_serialization(self):
+        import pickle
+        igrf = igrfModel(2011.5)
+        expect = igrf.geographic(9876.0, 51.0, 123.0)['field']
+        token = pickle.dumps(igrf, protocol=2)
+        self.assertTrue( len(token) < 300 )
+        copy = pickle.loads(token)
+        self.assertTrue( copy.coefficients is igrf.coefficients )   ;# shared per-process cache
+        self.assertAlmostEqual( copy.geographic(9876.0, 51.0, 123.0)['field']['up'], expect['up'] )
+
+        data = igrfModel(2011.5, dtype='float32').to_bytes()
+        self.assertEqual( len(data), 21 + len('igrf12') + 2*120*4 )
+        copy = igrfModel.from_bytes(data)
+        self.assertTrue( np.abs( copy.geographic(9876.0, 51.0, 123.0)['field']['up'] - expect['up'] ) < 0.1 )
+        copy.set_year(2000)
+        self.assertAlmostEqual( copy.gcoeff[0,1], igrfModel(2000).gcoeff[0,1], places=2 )
+        self.assertTrue( np.all( igrfModel(2000).gcoeff == igrfModel(2000).gcoeff ) )
+
+        # the coefficient source travels with the bytes
+        copy = igrfModel.from_bytes( igrfModel(2011.5, source='igrf11').to_bytes() )
+        self.assertEqual( copy.source, 'igrf11' )
+        copy.set_year(2012.5)
+        self.assertTrue( np.allclose( copy.gcoeff, igrfModel(2012.5, source='igrf11').gcoeff ) )
+        self.assertFalse( np.allclose( copy.gcoeff, igrfModel(2012.5).gcoeff ) )
+
+    def test_register(self):
+        # replacing a coefficient source also replaces the shared dense table
+        coefficients.register('test', lambda: coefficients.parse_igrf(igrfModel.coeff, 'test'))
+        g10 = igrfModel(2000, source='test').dipole()['g10']
+        self.assertAlmostEqual( g10, -29619.4 )
+        def doubled():
+            c = coefficients.parse_igrf(igrfModel.coeff, 'test')
+            return coefficients.gaussCoefficients('test', c.epochs, 2*c.g, 2*c.h)
+        coefficients.register('test', doubled)
+        self.assertAlmostEqual( igrfModel(2000, source='test').dipole()['g10'], 2*g10 )
+        self.assertAlmostEqual( coefficients.load('test').at(2000)[0][1], 2*g10 )
+
     def test_spherical(self):
         result = igrfModel(2000).spherical(r=6371.2e3, theta=0.0, phi=0.0) # Bx=27464.9, By=-3504.2, Bz=-14827.8)
         np.abs(result['field']['r'] - -55954.7) <= 0.1
@@ -892,6 +1138,40 @@ class BasicTest(unittest.TestCase):
         np.abs(result['field']['east'] - -3504.2) <= 0.1
         np.abs(result['field']['up'] - +14827.8) <= 0.1
 
+    def test_outputs(self):
+        igrf = igrfModel(2000)
+        full = igrf.geographic(9876.0, 51.0, 123.0, potential=True)['field']
+        part = igrf.geographic(9876.0, 51.0, 123.0, outputs=('F','D'))['field']
+        self.assertTrue( 'inclination' not in part and 'V' not in part )
+        self.assertAlmostEqual( part['field'], full['field'] )
+        self.assertAlmostEqual( part['declination'], full['declination'] )
+        part = igrf.spherical(r=7e6, theta=1.0, phi=2.0, outputs=('phi',))['field']
+        self.assertEqual( sorted(part.keys()), ['phi'] )
+        fdi = igrf.fdi(height=9876.0, latitude=51.0, longitude=123.0)['field']
+        self.assertAlmostEqual( fdi['inclination'], full['inclination'] )
+        self.assertRaises( ValueError, igrf.geographic, 0.0, 0.0, 0.0, outputs=('Q',) )
+        # each coordinate system only accepts what it can return
+        self.assertRaises( ValueError, igrf.geographic, 0.0, 0.0, 0.0, outputs=('x',) )
+        self.assertRaises( ValueError, igrf.spherical, 7e6, 1.0, 2.0, outputs=('F',) )
+        self.assertRaises( ValueError, igrf.cartesian, 7e6, 0.0, 0.0, outputs=('north',) )
+        full = igrf.cartesian(4e6, 5e6, 3e6, potential=True)['field']
+        part = igrf.cartesian(4e6, 5e6, 3e6, outputs=('z',), metadata=False)['field']
+        self.assertEqual( sorted(part.keys()), ['r', 'theta', 'z'] )
+        self.assertAlmostEqual( part['z'], full['z'] )
+        self.assertTrue( 'V' in full and 'x' in full )
+
+    def test_arrays(self):
+        # scattered points in several blocks agree with the scalar calculation
+        igrf = igrfModel(2000)
+        igrf.chunk = 7
+        random = np.random.RandomState(4)
+        r, theta, phi = random.uniform(6.4e6, 2e7, 20), random.uniform(0.01, 3.13, 20), random.uniform(0, 6.28, 20)
+        b = igrf.spherical(r, theta, phi)['field']
+        for i in [0, 8, 19]:
+            one = igrf.spherical(r[i], theta[i], phi[i])['field']
+            for name in ['r', 'theta', 'phi']:
+                self.assertAlmostEqual( b[name][i], one[name], places=6 )
+
     def test_cartesian(self):
         result = igrfModel(2000).cartesian(0.0, 0.0, 6371.2e3) # Bx=27464.9, By=-3504.2, Bz=-14827.8)
         np.abs(result['field']['x'] - +27464.9) <= 0.1
@@ -958,7 +1238,6 @@ def trace_conjugate(location, dstep=1e3):
     vec1a = igrf.spherical(pos1a)  # Euler's method
     pos1b = 0.5*dstep * (vec0 + vec1a)  # Heun's method
     err = pos1b - pos1a   # overly pessimistic
-'''
 
 from scipy.integrate import odeint
 
@@ -972,3 +1251,4 @@ t = np.linspace(0.0, 1.0e2, 100)
 y0 = (6.6*6371.2e3, 0.0, 0.0 )
 y1, infodict = odeint( trace, y0, t, full_output=True, h0=0.1, hmin=1e-3, hmax=1e6)
 plt.clf() ; plt.plot( y1[:,0]/6371.2e3, y1[:,1]/6371.2e3, 'go-' )
+'''
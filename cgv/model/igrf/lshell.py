@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+'''
+ lshell.py
+
+    McIlwain L-shell and invariant latitude for arrays of positions.
+
+    from igrf_model import igrfModel
+    from lshell import lshellCalculator
+    calc = lshellCalculator( igrfModel(2015) )
+    print calc.geographic(500e3, 65.0, 250.0)
+
+    {'I': array(27.80461727), 'Bm': array(46729.68338071),
+    'invariant_latitude': array(72.51695792), 'L': array(11.07980607)}
+
+    Each position is taken as the mirror point of a locally mirroring particle
+    (Bm = |B| at the position).  Field lines are traced in both directions
+    with a fixed-step Runge-Kutta integrator that advances all lines in
+    lockstep, dropping each line from the active set as soon as |B| rises
+    above Bm again.  The integral invariant
+
+        I = integral sqrt(1 - B/Bm) ds
+
+    is converted to L with the McIlwain function F(X) = L^3 Bm / M of the
+    dipole, X = I^3 Bm / M, which is tabulated once per process.
+
+    McIlwain, C.E. (1961), J. Geophys. Res., 66(11), 3681-3691
+'''
+
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+_table = None   ;# McIlwain function of a dipole, shared by all calculators
+
+def mcilwain_table(size=400, nodes=64):
+    """
+    Tabulate (log X, log Y) for a dipole where X = (I/Re)^3 Bm/B0 and
+    Y = (L)^3 Bm/B0 as a function of mirror latitude, up to 89.9 degrees
+    so that polar cap positions are covered.  The integral over magnetic
+    latitude uses the substitution lat = latm*sin(u) to remove the square
+    root behaviour at the mirror point.
+    """
+    global _table
+    if _table is not None and len(_table[0]) == size:
+        return _table
+    u, w = np.polynomial.legendre.leggauss(nodes)
+    u = np.pi/4.0 * (u + 1.0)  ;  w = np.pi/4.0 * w   ;# map [-1,1] onto [0,pi/2]
+
+    latm = np.linspace(0.0, 89.9, size+1)[1:] * np.pi/180.0
+    f = lambda lat: np.sqrt( 1.0 + 3.0*np.sin(lat)**2 ) / np.cos(lat)**6   ;# B L^3 / B0
+    lat = latm[:,None] * np.sin(u)
+    integrand = np.sqrt( np.clip( 1.0 - f(lat)/f(latm)[:,None], 0.0, None ) ) \
+        * np.cos(lat) * np.sqrt( 1.0 + 3.0*np.sin(lat)**2 ) * latm[:,None] * np.cos(u)
+    IL = 2.0 * np.sum( integrand * w, axis=1 )   ;# I/L, both hemispheres
+    Y = f(latm)
+    X = IL**3 * Y
+    _table = ( np.log(X), np.log(Y) )
+    return _table
+
+
+class lshellCalculator(object):
+    """
+    Batched McIlwain L and invariant latitude from vectorized field line tracing.
+    """
+
+    def __init__(self, model=None, step=0.05, max_steps=4000, verbose=0):
+        self.model = igrfModel() if model is None else model
+        self.step = step            ;# step length as a fraction of geocentric distance
+        self.max_steps = max_steps  ;# lines still active after this many steps give NaN
+        self.verbose = verbose
+        self.maps = {}   ;# precomputed lshellMap for each epoch
+
+
+    @property
+    def B0(self):
+        """ Dipole field [nT] of the model's current epoch. """
+        return self.model.dipole()['B0']
+
+
+    def field(self, xyz):
+        """ Field vector [nT] at an (n,3) array of cartesian positions [m]. """
+        b = self.model.cartesian(x=xyz[:,0], y=xyz[:,1], z=xyz[:,2], metadata=False)['field']
+        return np.column_stack( [b['x'], b['y'], b['z']] )
+
+
+    def _direction(self, xyz, sign):
+        b = self.field(xyz)
+        return sign[:,None] * b / np.sqrt( np.sum(b**2, axis=1) )[:,None]
+
+
+    def invariant(self, xyz):
+        """
+        Integral invariant I [Re] and mirror field Bm [nT] for particles
+        mirroring at an (n,3) array of cartesian positions [m].
+        """
+        xyz = np.atleast_2d( np.asarray(xyz, dtype='float') )
+        npts = len(xyz)
+        Bm = np.sqrt( np.sum( self.field(xyz)**2, axis=1 ) )
+        I = np.zeros(npts)
+
+        for direction in [+1.0, -1.0]:
+            index = np.arange(npts)   ;# lines that are still being traced
+            pos = xyz.copy()
+            g0 = np.zeros(npts)       ;# integrand at previous point, zero at the mirror point
+            for count in range(self.max_steps):
+                if len(index) == 0: break
+                p = pos[index] ;  sign = np.full(len(index), direction)
+                ds = self.step * np.sqrt( np.sum(p**2, axis=1) )[:,None]
+                k1 = self._direction(p, sign)
+                k2 = self._direction(p + 0.5*ds*k1, sign)
+                k3 = self._direction(p + 0.5*ds*k2, sign)
+                k4 = self._direction(p + ds*k3, sign)
+                p = p + ds * (k1 + 2.0*k2 + 2.0*k3 + k4) / 6.0
+                ds = ds[:,0] / self.model.Re
+
+                B = np.sqrt( np.sum( self.field(p)**2, axis=1 ) )
+                ratio = B / Bm[index]
+                done = ratio >= 1.0
+                g1 = np.sqrt( np.clip(1.0 - ratio, 0.0, None) )
+
+                # trapezoidal rule, last segment truncated at the mirror point
+                b0 = 1.0 - g0[index]**2   ;# B/Bm at previous point
+                fraction = np.where( done, (1.0 - b0) / np.maximum(ratio - b0, 1e-12), 1.0 )
+                I[index] += 0.5 * (g0[index] + g1) * ds * np.clip(fraction, 0.0, 1.0)
+
+                pos[index], g0[index] = p, g1
+                index = index[~done]
+            I[index] = np.nan   ;# never reached the conjugate mirror point
+
+        return I, Bm
+
+
+    def lvalue(self, I, Bm):
+        """
+        McIlwain L [Re] from integral invariant I [Re] and mirror field Bm [nT],
+        NaN beyond the end of the table rather than a clamped value.
+        """
+        logX, logY = mcilwain_table()
+        B0 = self.B0
+        X = np.log( np.maximum( I**3 * Bm / B0, 1e-300 ) )
+        Y = np.exp( np.interp(X, logX, logY, left=0.0, right=np.nan) )  ;# F(X) -> 1 for small X
+        return ( Y * B0 / Bm )**(1.0/3.0)
+
+
+    def cartesian(self, x, y, z):
+        x, y, z = np.broadcast_arrays(x, y, z)
+        I, Bm = self.invariant( np.column_stack( [np.ravel(x), np.ravel(y), np.ravel(z)] ) )
+        L = self.lvalue(I, Bm)
+        invariant_latitude = np.arccos( np.sqrt( np.clip(1.0/L, 0.0, 1.0) ) ) / self.model.dtor
+        result = dict( L=L, invariant_latitude=invariant_latitude, Bm=Bm, I=I )
+        for name in result: result[name] = result[name].reshape(x.shape)
+        return result
+
+
+    def geographic(self, height, latitude, longitude):
+        coords = self.model.convert_coordinates(height=height, latitude=latitude, longitude=longitude)
+        r, theta, phi = coords['r'], coords['theta'], coords['phi']
+        return self.cartesian( r*np.sin(theta)*np.cos(phi), r*np.sin(theta)*np.sin(phi), r*np.cos(theta) )
+
+
+    def map(self, heights, latitudes, longitudes):
+        """ Precomputed L-shell map for the current model epoch (cached). """
+        key = (self.model.year, tuple(heights), tuple(latitudes), tuple(longitudes))
+        if key not in self.maps:
+            self.maps[key] = lshellMap(self, heights, latitudes, longitudes)
+        return self.maps[key]
+        ########################################################################
+
+
+class lshellMap(object):
+    """
+    L-shell on a (height, latitude, longitude) grid for one epoch, so that
+    long ephemerides can be handled by interpolation instead of tracing.
+    """
+
+    def __init__(self, calculator, heights, latitudes, longitudes):
+        from scipy.interpolate import RegularGridInterpolator
+        self.year = calculator.model.year
+        self.axes = [ np.asarray(heights, dtype='float'), np.asarray(latitudes, dtype='float'),
+                      np.asarray(longitudes, dtype='float') ]
+        h, lat, lon = np.meshgrid( *self.axes, indexing='ij' )
+        self.table = calculator.geographic(h, lat, lon)
+        # longitude is periodic: repeat the first column at +360 so every longitude is inside the grid
+        lon0 = self.axes[2][0]
+        if self.axes[2][-1] < lon0 + 360.0:
+            self.axes[2] = np.append( self.axes[2], lon0 + 360.0 )
+            self.table = dict( (name, np.concatenate( [value, value[:,:,0:1]], axis=2 ))
+                               for name, value in self.table.items() )
+        self.interpolators = dict( (name, RegularGridInterpolator(self.axes, self.table[name],
+                                    bounds_error=False, fill_value=np.nan))
+                                   for name in ['L', 'invariant_latitude'] )
+
+
+    def __call__(self, height, latitude, longitude, quantity='L'):
+        height, latitude, longitude = np.broadcast_arrays(height, latitude, longitude)
+        longitude = np.mod( longitude - self.axes[2][0], 360.0 ) + self.axes[2][0]
+        points = np.column_stack( [np.ravel(height), np.ravel(latitude), np.ravel(longitude)] )
+        return self.interpolators[quantity](points).reshape(height.shape)
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def test_table(self):
+        logX, logY = mcilwain_table()
+        self.assertTrue( np.all( np.diff(logX) > 0 ) )
+        self.assertTrue( np.abs( logY[0] ) < 1e-3 )   ;# F(0) = 1
+        self.assertTrue( logX[-1] > 40.0 )   ;# mirror latitudes up to 89.9 degrees
+
+    def test_polar(self):
+        # polar cap positions are inside the table, anything past its end is NaN
+        calc = lshellCalculator( igrfModel(2015), step=0.1 )
+        result = calc.geographic(500e3, np.array([75.0, 85.0]), 250.0)
+        self.assertTrue( np.all( np.isfinite(result['L']) ) )
+        self.assertTrue( result['L'][1] > result['L'][0] > 10.0 )
+        self.assertTrue( result['invariant_latitude'][1] > result['invariant_latitude'][0] )
+        logX, logY = mcilwain_table()
+        Bm = np.array([50000.0])
+        I = ( np.exp(logX[-1] + 1.0) * calc.B0 / Bm )**(1.0/3.0)
+        self.assertTrue( np.isnan( calc.lvalue(I, Bm)[0] ) )
+
+    def test_equator(self):
+        # on the magnetic equator I=0 and L=(B0/B)^(1/3) Re
+        calc = lshellCalculator( igrfModel(2015) )
+        xyz = np.array([ [3.0*calc.model.Re, 0.0, 0.0] ])
+        I, Bm = calc.invariant(xyz)
+        L = calc.lvalue(I, Bm)
+        self.assertTrue( np.abs(L[0] - 3.0) < 0.3 )
+
+    def test_tracing(self):
+        calc = lshellCalculator( igrfModel(2015), step=0.02 )
+        result = calc.geographic(100e3, np.array([30.0, 45.0, 60.0]), 250.0)
+        self.assertTrue( np.all( np.isfinite(result['L']) ) )
+        self.assertTrue( np.all( np.diff(result['L']) > 0 ) )   ;# further out at higher latitude
+        coarse = lshellCalculator( igrfModel(2015), step=0.1 ).geographic(100e3, np.array([30.0, 45.0, 60.0]), 250.0)
+        self.assertTrue( np.all( np.abs(coarse['L'] - result['L']) < 0.01*result['L'] ) )
+
+    def test_map(self):
+        calc = lshellCalculator( igrfModel(2015), step=0.1 )
+        grid = calc.map([0.0, 500e3], [50.0, 60.0, 70.0], [0.0, 120.0, 240.0])
+        L = grid(250e3, 55.0, 60.0)
+        self.assertTrue( np.isfinite(L) and L > 1.0 )
+        L = grid(250e3, 55.0, np.array([300.0, -60.0, 359.9]))   ;# between the last column and 360
+        self.assertTrue( np.all( np.isfinite(L) ) and np.allclose( L[0], L[1] ) )
+
+    def test_epoch(self):
+        # dipole moment follows the model epoch
+        model = igrfModel(1900)
+        calc = lshellCalculator(model)
+        B1900 = calc.B0
+        model.set_year(2015)
+        self.assertAlmostEqual( calc.B0, model.dipole()['B0'] )
+        self.assertTrue( B1900 > calc.B0 + 1000.0 )
+
+if __name__ == "__main__":
+    unittest.main()
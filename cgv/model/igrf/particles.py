@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+'''
+ particles.py
+
+    Batched charged particle tracing in the main field, either as full
+    orbits (relativistic Boris pusher) or as guiding centres (drift and
+    mirror force, midpoint Runge-Kutta).
+
+    from igrf_model import igrfModel
+    from particles import particleTracer
+    tracer = particleTracer( igrfModel(2015), mode='guiding' )
+    state = tracer.initial(xyz, energy=1e6, pitch=45.0)      # eV, degrees
+    state = tracer.run(state, until=600.0, processes=4, checkpoint='run.npz', interval=60.0)
+    state['x'], state['status']
+
+    All particles advance in lockstep, so every step is a single batched
+    cartesian() call (seven points per particle for the finite difference
+    gradient of |B| in guiding centre mode).  Each particle has its own
+    time and step: a fraction of a gyroperiod for full orbits, or of the
+    time to cross the field gradient scale length (or to reverse the
+    parallel momentum) for guiding centres.  Particles are dropped from the
+    active set when they reach the end time, fall below the atmosphere
+    altitude, leave the outer boundary, or are inside the (dipole) loss cone.
+
+    The state is a dict of arrays, saved with np.savez at every checkpoint
+    interval of simulated time, so an interrupted run can be continued with
+    tracer.run( particleTracer.load('run.npz'), until=600.0 ).  With
+    processes > 1 the particles are split between worker processes; the
+    model is pickled as a small token (see igrfModel.__reduce__).
+
+    Positions are in metres (geocentric cartesian), u is momentum per unit
+    mass gamma*v [m/s] and time is in seconds.
+'''
+
+import os
+import multiprocessing
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+c = 299792458.0          ;# speed of light [m/s]
+e = 1.602176634e-19      ;# elementary charge [C]
+proton = 1.67262192e-27  ;# [kg]
+electron = 9.1093837e-31 ;# [kg]
+
+
+def _advance(args):
+    """ Worker process entry point: (tracer, state, until) -> state """
+    tracer, state, until = args
+    return tracer.advance(state, until)
+
+
+class particleTracer(object):
+    """
+    Lockstep Boris or guiding centre integration of many test particles.
+    """
+
+    codes = {'active':0, 'finished':1, 'atmosphere':2, 'escaped':3, 'loss_cone':4}
+    modes = ['boris', 'guiding']
+
+    def __init__(self, model=None, mode='boris', step=0.05, altitude=100.0e3, boundary=15.0,
+                 loss_cone=True, delta=1.0e-4, max_steps=1000000, verbose=0):
+        if mode not in self.modes:
+            raise ValueError('unknown mode %s, expected one of %s' % (mode, self.modes))
+        self.model = igrfModel() if model is None else model
+        self.mode = mode
+        self.step = step            ;# fraction of a gyroperiod (boris) or of the local scale (guiding)
+        self.altitude = altitude    ;# [m] particles below this are lost to the atmosphere
+        self.boundary = boundary    ;# [Re] particles beyond this have escaped
+        self.loss_cone = loss_cone  ;# stop particles whose mirror point is below altitude
+        self.delta = delta          ;# finite difference step as a fraction of geocentric distance
+        self.max_steps = max_steps  ;# per call of advance(), particles left over stay active
+        self.verbose = verbose
+        d = self.model.dipole()
+        self.axis = -np.array( [d['g11'], d['h11'], d['g10']] ) / d['B0']   ;# northern dipole pole
+        self.B0 = d['B0'] * 1.0e-9
+
+
+    def field(self, xyz):
+        """ Field vector [T] at an (n,3) array of cartesian positions [m]. """
+        b = self.model.cartesian(x=xyz[:,0], y=xyz[:,1], z=xyz[:,2], metadata=False)['field']
+        return np.column_stack( [b['x'], b['y'], b['z']] ) * 1.0e-9
+
+
+    def gradient(self, xyz):
+        """ Field vector, |B| [T] and grad|B| [T/m] from one call with 7 points per position. """
+        h = self.delta * np.sqrt( np.sum(xyz**2, axis=1) )
+        offsets = np.vstack( [np.zeros(3), np.eye(3), -np.eye(3)] )
+        B = self.field( (xyz[None,:,:] + offsets[:,None,:] * h[None,:,None]).reshape(-1,3) ).reshape(7,-1,3)
+        magnitude = np.sqrt( np.sum(B**2, axis=2) )
+        grad = ( magnitude[1:4] - magnitude[4:7] ).T / (2*h[:,None])
+        return B[0], magnitude[0], grad
+
+
+    def footprint(self, xyz):
+        """
+        |B| [T] where the (centred dipole) field line through each position
+        reaches the atmosphere altitude; infinite if it never does.
+        """
+        r = np.sqrt( np.sum(xyz**2, axis=1) )
+        ra = self.model.Re + self.altitude
+        sin2 = 1.0 - ( np.dot(xyz, self.axis) / r )**2   ;# magnetic colatitude
+        s2 = ra * sin2 / r   ;# sin^2 of the colatitude at ra, since r = L sin^2 along a dipole line
+        return np.where( s2 <= 1.0, self.B0 * (self.model.Re/ra)**3 * np.sqrt( 4.0 - 3.0*np.clip(s2, 0, 1) ), np.inf )
+
+
+    def initial(self, xyz, energy, pitch=90.0, phase=0.0, charge=1.0, mass=proton, time=0.0):
+        """
+        State for particles at (n,3) positions with kinetic energy [eV],
+        pitch angle and gyrophase [degrees], charge [e] and mass [kg].  For
+        guiding centres xyz is the guiding centre position.
+        """
+        xyz = np.atleast_2d( np.asarray(xyz, dtype='float') )
+        n = len(xyz)
+        energy, pitch, phase, charge, mass, time = [ np.broadcast_to(np.asarray(v, dtype='float'), (n,)).copy()
+                                                     for v in (energy, pitch, phase, charge, mass, time) ]
+        gamma = 1.0 + energy * e / (mass * c**2)
+        speed = c * np.sqrt( gamma**2 - 1.0 )   ;# |u|
+        B = self.field(xyz)
+        Bm = np.sqrt( np.sum(B**2, axis=1) )
+        upar = speed * np.cos( np.radians(pitch) )
+        uperp = speed * np.sin( np.radians(pitch) )
+        state = {'x':xyz.copy(), 't':time, 'charge':charge * e, 'mass':mass,
+                 'status':np.zeros(n, dtype='int8'), 'steps':np.zeros(n, dtype='int64')}
+        if self.mode == 'guiding':
+            state.update( upar=upar, mu=uperp**2 / (2*Bm) )
+        else:
+            b = B / Bm[:,None]
+            e1 = np.cross(b, np.where( np.abs(b[:,2:3]) < 0.9, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]] ))
+            e1 /= np.sqrt( np.sum(e1**2, axis=1) )[:,None]
+            e2 = np.cross(b, e1)
+            angle = np.radians(phase)[:,None]
+            state['u'] = upar[:,None]*b + uperp[:,None]*( np.cos(angle)*e1 + np.sin(angle)*e2 )
+        return state
+
+
+    def _boris(self, s, until):
+        """ One relativistic Boris step for every particle in the state s. """
+        B = self.field(s['x'])
+        Bm = np.sqrt( np.sum(B**2, axis=1) )
+        gamma = np.sqrt( 1.0 + np.sum(s['u']**2, axis=1) / c**2 )
+        qm = s['charge'] / s['mass']
+        dt = np.minimum( self.step * 2*np.pi * gamma / (np.abs(qm) * Bm), until - s['t'] )
+        t = (0.5 * qm * dt / gamma)[:,None] * B
+        v = 2*t / (1.0 + np.sum(t**2, axis=1))[:,None]
+        u = s['u'] + np.cross( s['u'] + np.cross(s['u'], t), v )
+        s['u'] = u
+        s['x'] = s['x'] + u * (dt / gamma)[:,None]
+        s['t'] = s['t'] + dt
+        u2 = np.sum(u**2, axis=1)
+        upar2 = np.sum(u*B, axis=1)**2 / Bm**2
+        return Bm * u2 / np.maximum(u2 - upar2, 1e-300)   ;# mirror field
+
+
+    def _drift(self, s, x, upar):
+        """ Guiding centre velocity and parallel acceleration (curl free field). """
+        B, Bm, grad = self.gradient(x)
+        b = B / Bm[:,None]
+        gamma = np.sqrt( 1.0 + (upar**2 + 2*s['mu']*Bm) / c**2 )
+        drift = (s['mass'] / s['charge']) * (s['mu']*Bm + upar**2) / (gamma * Bm**2)
+        dxdt = (upar/gamma)[:,None] * b + drift[:,None] * np.cross(b, grad)
+        dudt = -(s['mu']/gamma) * np.sum(b*grad, axis=1)
+        scale = np.minimum( Bm / np.maximum( np.sqrt( np.sum(grad**2, axis=1) ), 1e-300 ),
+                            np.sqrt( np.sum(x**2, axis=1) ) )
+        limit = np.minimum( scale / np.maximum( np.sqrt( np.sum(dxdt**2, axis=1) ), 1e-300 ),
+                            np.sqrt( upar**2 + 2*s['mu']*Bm ) / np.maximum( np.abs(dudt), 1e-300 ) )
+        return dxdt, dudt, Bm, limit
+
+
+    def _guiding(self, s, until):
+        """ One midpoint Runge-Kutta guiding centre step for every particle in s. """
+        k1x, k1u, Bm, limit = self._drift(s, s['x'], s['upar'])
+        dt = np.minimum( self.step * limit, until - s['t'] )
+        k2x, k2u, Bm, limit = self._drift(s, s['x'] + 0.5*dt[:,None]*k1x, s['upar'] + 0.5*dt*k1u)
+        s['x'] = s['x'] + dt[:,None] * k2x
+        s['upar'] = s['upar'] + dt * k2u
+        s['t'] = s['t'] + dt
+        return Bm + s['upar']**2 / (2*s['mu'])   ;# mirror field
+
+
+    def advance(self, state, until):
+        """ Integrate all active particles to time until [s]; returns the updated state. """
+        state = dict( (name, np.array(value)) for name, value in state.items() )
+        push = self._boris if self.mode == 'boris' else self._guiding
+        per_particle = [name for name, value in state.items() if np.ndim(value) > 0]
+        index = np.flatnonzero( (state['status'] == 0) & (state['t'] < until) )
+        for count in range(self.max_steps):
+            if len(index) == 0: break
+            s = dict( (name, state[name][index]) for name in per_particle )
+            Bmirror = push(s, until)
+            s['steps'] += 1
+
+            r = np.sqrt( np.sum(s['x']**2, axis=1) )
+            status = np.zeros(len(index), dtype='int8')
+            if self.loss_cone: status[ Bmirror > self.footprint(s['x']) ] = self.codes['loss_cone']
+            status[ r > self.boundary * self.model.Re ] = self.codes['escaped']
+            status[ r < self.model.Re + self.altitude ] = self.codes['atmosphere']
+            s['status'] = status
+            for name in per_particle: state[name][index] = s[name]
+            index = index[ (status == 0) & (s['t'] < until) ]
+            if self.verbose and count % 1000 == 0: print('step %d, %d active' % (count, len(index)))
+        return state
+
+
+    def run(self, state, until, processes=1, checkpoint=None, interval=None):
+        """
+        Integrate to time until [s], optionally split across worker processes
+        and saving the state to checkpoint every interval seconds of
+        simulated time.  Particles still active at the end are marked finished.
+        """
+        edges = [until]
+        if interval is not None:
+            start = np.min( state['t'][ state['status'] == 0 ] ) if np.any(state['status'] == 0) else until
+            edges = list( interval * np.arange( np.floor(start/interval) + 1, np.ceil(until/interval) ) ) + [until]
+
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            for edge in edges:
+                if pool is None:
+                    state = self.advance(state, edge)
+                else:
+                    chunks = np.array_split( np.arange(len(state['t'])), processes )
+                    parts = pool.map( _advance, [ (self, self.take(state, chunk), edge) for chunk in chunks ] )
+                    state = dict( (name, np.concatenate([part[name] for part in parts]) if np.ndim(state[name]) else state[name])
+                                  for name in state )
+                if checkpoint is not None: self.save(checkpoint, state)
+        finally:
+            if pool is not None: pool.close() ; pool.join()
+
+        state['status'][ (state['status'] == 0) & (state['t'] >= until) ] = self.codes['finished']
+        return state
+
+
+    @staticmethod
+    def take(state, index):
+        """ Subset of the particles in a state. """
+        return dict( (name, value[index] if np.ndim(value) else value) for name, value in state.items() )
+
+
+    @staticmethod
+    def save(path, state):
+        """ Write the state to an .npz file (via a temporary file, so an interrupted write is harmless). """
+        temporary = path + '.tmp.npz'
+        np.savez(temporary, **state)
+        os.rename(temporary, path)
+
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return dict( (name, data[name]) for name in data.files )
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = igrfModel(2015)
+        self.xyz = np.array( [[4.0*self.model.Re, 0.0, 0.0], [0.0, -4.0*self.model.Re, 0.0]] )
+
+    def test_boris(self):
+        # energy is conserved and a trapped 1 MeV proton stays near L=4
+        tracer = particleTracer(self.model, mode='boris')
+        state = tracer.initial(self.xyz, energy=1.0e6, pitch=60.0)
+        speed = np.sqrt( np.sum(state['u']**2, axis=1) )
+        state = tracer.run(state, until=5.0)
+        self.assertTrue( np.all( state['status'] == tracer.codes['finished'] ) )
+        self.assertTrue( np.allclose( np.sqrt( np.sum(state['u']**2, axis=1) ), speed, rtol=1e-10 ) )
+        r = np.sqrt( np.sum(state['x']**2, axis=1) ) / self.model.Re
+        self.assertTrue( np.all( np.abs(r - 4.0) < 0.3 ) )
+
+    def test_guiding(self):
+        # protons drift west, electrons east, and the guiding centre agrees with the full orbit
+        tracer = particleTracer(self.model, mode='guiding')
+        xyz = self.xyz[0:1].repeat(2, axis=0)
+        state = tracer.initial(xyz, energy=1.0e6, pitch=90.0, charge=[1.0, -1.0], mass=[proton, electron])
+        state = tracer.run(state, until=2.0)
+        longitude = np.degrees( np.arctan2(state['x'][:,1], state['x'][:,0]) )
+        self.assertTrue( longitude[0] < 0.0 and longitude[1] > 0.0 )
+
+        boris = particleTracer(self.model, mode='boris', step=0.02)
+        orbit = boris.run( boris.initial(xyz[0:1], energy=1.0e6, pitch=90.0), until=2.0 )
+        gyroradius = 2.3e-20 / (e * 5e-7)   ;# p/qB, about 300 km
+        self.assertTrue( np.sqrt( np.sum( (orbit['x'][0] - state['x'][0])**2 ) ) < 2*gyroradius )
+
+    def test_bounce(self):
+        # mirror force reverses the parallel momentum, mu is unchanged
+        tracer = particleTracer(self.model, mode='guiding', loss_cone=False)
+        state = tracer.initial(self.xyz[0:1], energy=1.0e5, pitch=30.0)
+        mu = state['mu'].copy()
+        upar = []
+        for until in np.arange(0.5, 10.0, 0.5):
+            state = tracer.advance(state, until)
+            upar.append( state['upar'][0] )
+        self.assertTrue( np.min(upar) < 0 < np.max(upar) )
+        self.assertTrue( np.all( state['mu'] == mu ) )
+
+    def test_termination(self):
+        tracer = particleTracer(self.model, mode='guiding')
+        xyz = np.array( [[4.0*self.model.Re, 0.0, 0.0], [1.01*self.model.Re, 0.0, 0.0], [16.0*self.model.Re, 0.0, 0.0]] )
+        state = tracer.run( tracer.initial(xyz, energy=1.0e5, pitch=[2.0, 90.0, 90.0]), until=1.0 )
+        self.assertEqual( list(state['status']), [tracer.codes['loss_cone'], tracer.codes['atmosphere'], tracer.codes['escaped']] )
+
+    def test_checkpoint(self):
+        import tempfile
+        tracer = particleTracer(self.model, mode='guiding')
+        path = os.path.join( tempfile.mkdtemp(), 'particles.npz' )
+        state = tracer.initial(self.xyz, energy=[1.0e5, 2.0e5], pitch=[40.0, 70.0])
+        whole = tracer.run(state, until=2.0, interval=0.5)
+        tracer.run(state, until=1.0, checkpoint=path, interval=0.5)
+        resumed = tracer.run( particleTracer.load(path), until=2.0, interval=0.5 )
+        parallel = tracer.run(state, until=2.0, interval=0.5, processes=2)
+        for name in ['x', 'upar', 't', 'status']:
+            self.assertTrue( np.all( resumed[name] == whole[name] ) )
+            self.assertTrue( np.all( parallel[name] == whole[name] ) )
+        os.remove(path)
+
+if __name__ == "__main__":
+    unittest.main()
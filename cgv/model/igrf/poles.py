@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+'''
+ poles.py
+
+    Geomagnetic poles, dip poles, the dip equator and lines of constant
+    declination for one or many epochs.
+
+    from poles import poleLocator
+    locate = poleLocator()
+    print locate.dip_poles(2015)
+
+    {'north': (86.2888089245151, -160.02939030164825),
+     'south': (-64.27786820995497, 136.58638097685022)}
+
+    latitude = locate.dip_equator(2015, longitudes=np.arange(0, 360, 5.0))
+
+    poles = locate.series('dip_poles', range(1900, 2021))   # all epochs solved together
+
+    Roots are found with Newton's method, batched over all starting points
+    and all epochs that are not cached yet: each iteration is a single
+    field evaluation (every point with its own epoch's coefficients, via
+    the design matrix of design.py) that also covers the points needed for
+    a central difference Jacobian.  Results are cached per epoch, so
+    repeated requests (eg. for annual products) are lookups.
+'''
+
+import numpy as np
+import unittest
+
+import coefficients
+from design import design_matrix, pack
+from igrf_model import igrfModel
+
+
+class poleLocator(object):
+    """
+    Vectorized Newton root finding for special points of the main field.
+    """
+
+    def __init__(self, height=0.0, step=1.0e-3, tolerance=1.0e-7, iterations=30, source='igrf12', chunk=4096):
+        self.height = height          ;# metres above the ellipsoid
+        self.step = step              ;# degrees, for finite differences
+        self.tolerance = tolerance    ;# degrees
+        self.iterations = iterations
+        self.source = source          ;# coefficient source, see coefficients.py
+        self.chunk = chunk            ;# points per design matrix block
+        self.vectors = {}   ;# epoch -> coefficient vector (g10, g11, h11, ...)
+        self.cache = {}     ;# (quantity, epoch, ...) -> result
+        self.evaluations = 0
+        self._reference = None
+
+
+    def vector(self, epoch):
+        if epoch not in self.vectors:
+            source = coefficients.load(self.source)
+            self.vectors[epoch] = pack( *source.at(epoch), degree=source.degree )
+        return self.vectors[epoch]
+
+
+    def field(self, epochs, latitude, longitude, outputs=('north','east','up')):
+        """
+        Geodetic field components [nT] at points that each have their own
+        epoch, as one batched evaluation: rows of the design matrix times
+        the coefficient vector of each point's epoch.
+        """
+        source = coefficients.load(self.source)
+        if self._reference is None: self._reference = igrfModel()   ;# only for the WGS-84 conversion
+        latitude, longitude = np.asarray(latitude, dtype='float'), np.asarray(longitude, dtype='float')
+        unique, which = np.unique( np.broadcast_to(epochs, latitude.shape), return_inverse=True )
+        X = np.array( [self.vector(epoch) for epoch in unique] )
+        coords = self._reference.convert_coordinates(height=np.full(latitude.shape, self.height),
+                                                     latitude=latitude, longitude=longitude)
+        result = dict( (name, np.empty(latitude.shape)) for name in outputs )
+        for start in range(0, latitude.size, self.chunk):
+            s = slice(start, start+self.chunk)
+            A = design_matrix(coords['r'][s], coords['theta'][s], coords['phi'][s], source.degree,
+                              source.radius, outputs, psi=coords['psi'][s])
+            for name in outputs: result[name][s] = np.einsum('np,np->n', A[name], X[which[s]])
+        self.evaluations += 1
+        return result
+
+
+    def series(self, quantity, epochs, **kwargs):
+        """
+        One of the locators for a sequence of epochs, eg.
+        series('dip_poles', range(1900,2021)).  All epochs that are not
+        cached yet are solved together in one batched Newton iteration.
+        """
+        solve = {'geomagnetic_poles':self._geomagnetic, 'dip_poles':self._dip_poles,
+                 'dip_equator':self._equator, 'declination_contour':self._declination}[quantity]
+        options = tuple( sorted( (name, tuple(np.ravel(value))) for name, value in kwargs.items() ) )
+        key = lambda epoch: (quantity, epoch, options)
+        missing = sorted( set( epoch for epoch in epochs if key(epoch) not in self.cache ) )
+        if missing:
+            for epoch, result in zip( missing, solve(missing, **kwargs) ):
+                self.cache[key(epoch)] = result
+        return [ self.cache[key(epoch)] for epoch in epochs ]
+
+
+    def geomagnetic_poles(self, epoch):
+        """ Northern and southern geomagnetic (dipole axis) poles: dict of (latitude, longitude). """
+        return self.series('geomagnetic_poles', [epoch])[0]
+
+    def _geomagnetic(self, epochs):
+        result = []
+        for epoch in epochs:
+            g10, g11, h11 = self.vector(epoch)[0:3]
+            axis = -np.array( [g11, h11, g10] ) / np.sqrt( g10**2 + g11**2 + h11**2 )
+            latitude = np.degrees( np.arcsin(axis[2]) )
+            longitude = np.degrees( np.arctan2(axis[1], axis[0]) )
+            result.append( {'north':(latitude, longitude), 'south':(-latitude, np.mod(longitude + 360.0, 360.0) - 180.0)} )
+        return result
+
+
+    def _newton1(self, epochs, residual, latitude, longitude):
+        """ Solve residual(field) = 0 along meridians, starting from latitude, each point at its own epoch. """
+        h = self.step
+        latitude = np.array(latitude, dtype='float')
+        epochs = np.concatenate( [epochs] * 3 )
+        lon = np.concatenate( [longitude] * 3 )
+        for count in range(self.iterations):
+            lat = np.concatenate( [latitude, latitude + h, latitude - h] )
+            f = residual( self.field(epochs, lat, lon) )
+            f0, fp, fm = np.split(f, 3)
+            delta = f0 / ( (fp - fm) / (2*h) )
+            latitude -= np.clip(delta, -5.0, 5.0)
+            if np.all( np.abs(delta) < self.tolerance ): break
+        converged = (np.abs(delta) < self.tolerance) & (np.abs(latitude) <= 90.0)
+        return np.where(converged, latitude, np.nan)
+
+
+    def dip_equator(self, epoch, longitudes=np.arange(0.0, 360.0, 1.0)):
+        """ Geodetic latitude of zero inclination at each longitude. """
+        return self.series('dip_equator', [epoch], longitudes=longitudes)[0]
+
+    def _equator(self, epochs, longitudes=np.arange(0.0, 360.0, 1.0)):
+        longitudes = np.asarray(longitudes, dtype='float')
+        lon = np.tile( longitudes, len(epochs) )
+        latitude = self._newton1( np.repeat(epochs, len(longitudes)), lambda b: b['up'], np.zeros(len(lon)), lon )
+        return list( latitude.reshape(len(epochs), -1) )
+
+
+    def declination_contour(self, epoch, declination, longitudes, start=0.0):
+        """
+        Latitude along each meridian where the declination equals the given
+        value [degrees], found from the starting latitude(s); NaN where the
+        iteration does not converge on that contour.
+        """
+        return self.series('declination_contour', [epoch], declination=declination, longitudes=longitudes, start=start)[0]
+
+    def _declination(self, epochs, declination, longitudes, start=0.0):
+        longitudes = np.asarray(longitudes, dtype='float')
+        start = np.broadcast_to(start, longitudes.shape).astype('float')
+        c, s = np.cos( np.radians(declination) ), np.sin( np.radians(declination) )
+        ep, lon = np.repeat(epochs, len(longitudes)), np.tile(longitudes, len(epochs))
+        # H sin(D-D0) is smooth, and zero on the contour (and on D0+180)
+        latitude = self._newton1(ep, lambda b: b['east']*c - b['north']*s, np.tile(start, len(epochs)), lon)
+        b = self.field(ep, np.nan_to_num(latitude), lon, outputs=('north','east'))
+        latitude = np.where( b['north']*c + b['east']*s > 0, latitude, np.nan )
+        return list( latitude.reshape(len(epochs), -1) )
+
+
+    def dip_poles(self, epoch):
+        """
+        Northern and southern dip poles (zero horizontal field): dict of
+        (latitude, longitude).  Newton iteration is done in polar azimuthal
+        coordinates around each geographic pole, which are smooth through
+        the pole, starting from the geomagnetic poles.
+        """
+        return self.series('dip_poles', [epoch])[0]
+
+    def _dip_poles(self, epochs):
+        h = self.step
+        start = self._geomagnetic(epochs)
+        hemisphere = np.tile( [1.0, -1.0], len(epochs) )
+        ep = np.tile( np.repeat(epochs, 2), 5 )
+        lat0 = np.array( [ p[name][0] for p in start for name in ['north', 'south'] ] )
+        lon0 = np.radians( [ p[name][1] for p in start for name in ['north', 'south'] ] )
+        rho = 90.0 - hemisphere*lat0
+        uv = np.column_stack( [rho*np.cos(lon0), rho*np.sin(lon0)] )
+        offsets = np.array( [[0,0], [h,0], [-h,0], [0,h], [0,-h]] )
+        for count in range(self.iterations):
+            points = (uv[None,:,:] + offsets[:,None,:]).reshape(-1,2)
+            rho = np.sqrt( np.sum(points**2, axis=1) )
+            lon = np.arctan2( points[:,1], points[:,0] )
+            lat = np.tile(hemisphere, 5) * (90.0 - rho)
+            b = self.field(ep, lat, np.degrees(lon), outputs=('north','east'))
+            radial = -np.tile(hemisphere, 5) * b['north']   ;# away from the geographic pole
+            f = np.column_stack( [radial*np.cos(lon) - b['east']*np.sin(lon),
+                                  radial*np.sin(lon) + b['east']*np.cos(lon)] ).reshape(5,-1,2)
+            J = np.stack( [(f[1]-f[2])/(2*h), (f[3]-f[4])/(2*h)], axis=-1 )   ;# (poles, 2, 2)
+            delta = np.linalg.solve(J, f[0][...,None])[...,0]
+            uv -= np.clip(delta, -5.0, 5.0)
+            if np.all( np.abs(delta) < self.tolerance ): break
+        rho = np.sqrt( np.sum(uv**2, axis=1) )
+        latitude = hemisphere * (90.0 - rho)
+        longitude = np.degrees( np.arctan2(uv[:,1], uv[:,0]) )
+        return [ {'north':(latitude[2*k], longitude[2*k]), 'south':(latitude[2*k+1], longitude[2*k+1])}
+                 for k in range(len(epochs)) ]
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locate = poleLocator()
+
+    def test_geomagnetic(self):
+        poles = self.locate.geomagnetic_poles(2015)
+        self.assertAlmostEqual( poles['north'][0], 80.31, places=2 )
+        self.assertAlmostEqual( poles['north'][1], -72.63, places=2 )
+
+    def test_dip_poles(self):
+        poles = self.locate.dip_poles(2015)
+        igrf = igrfModel(2015)
+        for name in ['north', 'south']:
+            b = igrf.geographic(0.0, poles[name][0], poles[name][1])['field']
+            self.assertTrue( b['horizontal'] < 0.01 )
+        self.assertTrue( poles['north'][0] > 84.0 and poles['south'][0] < -60.0 )
+        self.assertTrue( self.locate.dip_poles(2015) is poles )   ;# cached
+
+    def test_equator(self):
+        longitudes = np.arange(0.0, 360.0, 30.0)
+        latitude = self.locate.dip_equator(2010, longitudes)
+        inclination = igrfModel(2010).geographic(0.0, latitude, longitudes)['field']['inclination']
+        self.assertTrue( np.all( np.abs(inclination) < 1e-4 ) )
+
+    def test_declination(self):
+        longitudes = np.array( [240.0, 250.0] )
+        latitude = self.locate.declination_contour(2010, 15.0, longitudes, start=60.0)
+        D = igrfModel(2010).geographic(0.0, latitude, longitudes)['field']['declination']
+        self.assertTrue( np.all( np.abs(D - 15.0) < 1e-4 ) )
+        self.assertTrue( np.all( (latitude > 35.0) & (latitude < 65.0) ) )
+
+    def test_series(self):
+        # several epochs in one batched Newton iteration agree with one at a time
+        epochs = [2000.0, 2005.0, 2010.0]
+        longitudes = np.arange(0.0, 360.0, 45.0)
+        latitude = self.locate.series('dip_equator', epochs, longitudes=longitudes)
+        self.assertTrue( self.locate.evaluations <= self.locate.iterations )
+        for epoch, lat in zip(epochs, latitude):
+            self.assertTrue( np.allclose( lat, poleLocator().dip_equator(epoch, longitudes), atol=1e-6 ) )
+        poles = self.locate.series('dip_poles', epochs)
+        self.assertTrue( np.allclose( poles[2]['south'], poleLocator().dip_poles(2010.0)['south'], atol=1e-6 ) )
+        self.assertTrue( self.locate.dip_poles(2005.0) is poles[1] )   ;# cached
+
+if __name__ == "__main__":
+    unittest.main()
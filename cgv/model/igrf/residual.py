@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+ residual.py
+
+    Remove the IGRF main field from streams of magnetometer data.
+
+    from residual import residualStream
+    stage = residualStream(frame='NEU')
+    for chunk in stage.stream(chunks):     # chunks of (time, position, measured)
+        ...
+
+    time is in decimal years (or numpy datetime64), position is an (n,3)
+    array of (height [m], latitude, longitude) as for igrfModel.geographic()
+    and measured is an (n,3) array of vectors [nT] in the selected frame.
+
+    The model is evaluated on knots every bucket (one day by default) and
+    interpolated linearly in time between them.  Within an IGRF epoch the
+    coefficients are linear in time, so this is exact and residual series
+    have no steps at bucket boundaries.  Positions that repeat, such as
+    fixed ground stations, are recognised automatically and their knot
+    values are kept in a bounded cache so that they are only calculated
+    once per knot instead of per sample.  The same knotCache is used for
+    the dB/dt station baseline in dbdt.py.
+'''
+
+import collections
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+def decimal_year(time):
+    """ Decimal year from numpy datetime64 values; numbers are returned unchanged. """
+    time = np.asarray(time)
+    if not np.issubdtype(time.dtype, np.datetime64):
+        return time.astype('float')
+    year = time.astype('datetime64[Y]')
+    start = year.astype('datetime64[ns]')
+    length = (year + 1).astype('datetime64[ns]') - start
+    return 1970.0 + year.astype('float') + (time.astype('datetime64[ns]') - start) / length
+
+
+class knotCache(object):
+    """
+    Main field at arrays of times and positions, from model evaluations on
+    knots every step years that are interpolated linearly in time.
+    """
+
+    def __init__(self, step=1.0/365.25, components=(('east',1.0), ('north',1.0), ('up',1.0)),
+                 cache_size=10000, models=16, model=igrfModel):
+        self.step = step              ;# years between knots
+        self.components = list(components)   ;# (name, sign) of each output column
+        self.cache_size = cache_size  ;# fixed station knot values kept
+        self.cache = collections.OrderedDict()   ;# (knot, height, lat, lon) -> vector, least recent first
+        self.recent = self._void( np.zeros([0,4]) )   ;# keys seen once lately, cached if they come back
+        self._cached = None                              ;# keys of the cache as one array, rebuilt when it changes
+        self.factory = model
+        self.models = collections.OrderedDict()  ;# knot -> model at the knot time
+        self.max_models = models
+        self.calls = 0   ;# number of positions passed to the model
+
+
+    def model(self, knot):
+        if knot in self.models:
+            self.models[knot] = self.models.pop(knot)   ;# most recent
+        else:
+            self.models[knot] = self.factory( knot * self.step )
+            while len(self.models) > self.max_models: self.models.popitem(last=False)
+        return self.models[knot]
+
+
+    def field(self, knot, position):
+        """ Model field [nT] for an (n,3) array of positions at one knot. """
+        b = self.model(knot).geographic(position[:,0], position[:,1], position[:,2], metadata=False,
+                                        outputs=[name for name, sign in self.components])['field']
+        self.calls += len(position)
+        return np.column_stack( [sign * b[name] for name, sign in self.components] )
+
+
+    @staticmethod
+    def _void(keys):
+        """ One opaque element per (knot, height, latitude, longitude) row, for vectorized membership tests. """
+        keys = np.ascontiguousarray(keys + 0.0)   ;# no negative zero
+        return keys.view( np.dtype( (np.void, keys.dtype.itemsize * keys.shape[1]) ) ).ravel()
+
+
+    def knots(self, keys):
+        """
+        Model field [nT] for an (n,4) array of (knot, height, latitude,
+        longitude) keys.  Only keys that repeat (fixed stations) go through
+        the dict cache; samples from moving platforms go straight to one
+        vectorized geographic() call per knot.
+        """
+        keys, index, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        void = self._void(keys)
+        if self._cached is None:
+            self._cached = self._void( np.array( list(self.cache), dtype='float' ).reshape(-1,4) )
+        cached = np.in1d(void, self._cached)
+        station = cached | (counts > 1) | np.in1d(void, self.recent)
+
+        vectors = np.empty( [len(keys), len(self.components)] )
+        for k in np.flatnonzero(cached):
+            key = tuple(keys[k])
+            vectors[k] = self.cache[key] = self.cache.pop(key)   ;# most recent
+
+        for knot in np.unique( keys[~cached,0] ):
+            select = np.flatnonzero( ~cached & (keys[:,0] == knot) )
+            vectors[select] = self.field( int(knot), keys[select,1:] )
+
+        # positions that repeat (within or between calls) are fixed stations, remember them
+        new = np.flatnonzero( station & ~cached )
+        for k in new: self.cache[tuple(keys[k])] = vectors[k]
+        if len(new): self._cached = None
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)  ;  self._cached = None
+        self.recent = np.concatenate( [self.recent, void[~station]] )[-self.cache_size:]
+
+        return vectors[ np.ravel(index) ]
+
+
+    def __call__(self, time, position):
+        """
+        Model field [nT] for arrays of times (decimal years or datetime64) and
+        (n,3) positions, interpolated between the knots before and after each
+        sample.  Within an IGRF epoch this is exact, since the coefficients
+        are linear in time.
+        """
+        time = np.atleast_1d( decimal_year(time) )
+        position = np.atleast_2d( np.asarray(position, dtype='float') )
+        number = np.floor( time / self.step )
+        keys = np.column_stack( [np.concatenate([number, number+1]), np.concatenate([position, position])] )
+        vectors = self.knots(keys)
+        before, after = vectors[0:len(time)], vectors[len(time):]
+        return before + (time / self.step - number)[:,None] * (after - before)
+        ########################################################################
+
+
+class residualStream(object):
+    """
+    Streaming subtraction of the main field from measured vectors.
+    """
+
+    # components in each frame, with sign
+    frames = {'ENU':[('east',1.0), ('north',1.0), ('up',1.0)],
+              'NEU':[('north',1.0), ('east',1.0), ('up',1.0)],
+              'NED':[('north',1.0), ('east',1.0), ('up',-1.0)]}
+
+    def __init__(self, frame='ENU', bucket=1.0/365.25, cache_size=10000, models=16, verbose=0):
+        if frame not in self.frames:
+            raise ValueError('unknown frame %s, expected one of %s' % (frame, sorted(self.frames)))
+        self.frame = frame
+        self.bucket = bucket          ;# years between knots
+        self.field = knotCache(bucket, self.frames[frame], cache_size=cache_size, models=models)
+        self.verbose = verbose
+
+
+    def baseline(self, time, position):
+        """ Model field [nT] in the stream frame for arrays of times and (n,3) positions. """
+        return self.field(time, position)
+
+
+    def process(self, time, position, measured):
+        """ Residual (measured minus model) vectors for one chunk. """
+        return np.asarray(measured, dtype='float') - self.baseline(time, position)
+
+
+    def stream(self, chunks):
+        """ Generator of residuals for an iterable of (time, position, measured) chunks. """
+        for time, position, measured in chunks:
+            yield self.process(time, position, measured)
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def test_decimal_year(self):
+        self.assertAlmostEqual( decimal_year(np.datetime64('2015-07-02T12:00')), 2015.5, places=2 )
+        self.assertEqual( decimal_year(2015.25), 2015.25 )
+
+    def test_station(self):
+        stage = residualStream(frame='NEU')
+        n = 600
+        time = np.datetime64('2015-03-01') + np.arange(n) * np.timedelta64(1,'s')
+        position = np.tile( [0.0, 51.0, 246.0], (n,1) )
+        field = igrfModel( decimal_year(time[0]) ).geographic(0.0, 51.0, 246.0)['field']
+        measured = np.tile( [field['north'], field['east'], field['up']], (n,1) ) + 5.0
+        chunks = [ (time[i:i+100], position[i:i+100], measured[i:i+100]) for i in range(0, n, 100) ]
+        residuals = np.concatenate( list( stage.stream(chunks) ) )
+        self.assertEqual( residuals.shape, (n,3) )
+        self.assertTrue( np.all( np.abs(residuals - 5.0) < 1.0 ) )
+        self.assertEqual( stage.field.calls, 2 )   ;# fixed station calculated once per knot
+
+        # one sample per chunk is recognised on the second chunk
+        for i in range(3):
+            stage.process(time[i:i+1], [[0.0, 60.0, 250.0]], measured[i:i+1])
+        self.assertEqual( stage.field.calls, 6 )
+
+    def test_knots(self):
+        # hourly samples over two days match the model at each sample time, with no daily steps
+        stage = residualStream(frame='ENU')
+        time = np.datetime64('2015-03-17') + np.arange(48) * np.timedelta64(1,'h')
+        position = np.tile( [0.0, 65.0, 213.0], (48,1) )
+        expect = [ igrfModel( float( decimal_year(t) ) ).geographic(0.0, 65.0, 213.0)['field'] for t in time ]
+        expect = np.array( [ [b['east'], b['north'], b['up']] for b in expect ] )
+        residual = stage.process(time, position, expect)
+        self.assertTrue( np.all( np.abs(residual) < 1e-6 ) )
+        self.assertEqual( stage.field.calls, 4 )   ;# samples fall in three buckets: four knots
+
+    def test_satellite(self):
+        stage = residualStream(frame='ENU')
+        position = np.column_stack( [np.full(50, 500e3), np.linspace(-60, 60, 50), np.linspace(0, 30, 50)] )
+        residual = stage.process(np.full(50, 2012.0), position, np.zeros([50,3]))
+        expect = igrfModel(2012.0).geographic(500e3, position[7,1], position[7,2])['field']
+        self.assertAlmostEqual( residual[7,0], -expect['east'], places=6 )
+        self.assertEqual( len(stage.field.cache), 0 )   ;# moving platform is not cached
+
+        # long moving platform chunks only keep a bounded array of recent keys
+        stage = residualStream(cache_size=100)
+        track = np.column_stack( [np.full(5000, 500e3), np.linspace(-80, 80, 5000), np.linspace(0, 300, 5000)] )
+        stage.process(np.full(5000, 2012.0), track, np.zeros([5000,3]))
+        self.assertEqual( (len(stage.field.cache), len(stage.field.recent), stage.field.calls), (0, 100, 2*5000) )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''
+ tiles.py
+
+    Multi-resolution cache of IGRF map products (declination, inclination,
+    total field etc.) stored on disk as memory-mapped arrays.
+
+    from tiles import tileCache
+    cache = tileCache('/tmp/igrf_tiles')
+    cache.build(2015.0, altitude=0.0, zoom=3)       # cheap coarse levels
+    D = cache.tile(2015.0, 'D', 0.0, 5, 40, 12)     # lazy, generated on demand
+
+    Tiles use an equirectangular (plate carree) pyramid: zoom level z has
+    2**(z+1) tiles in longitude and 2**z tiles in latitude, tile (0,0) is
+    in the north-west corner, and each tile holds size x size values at the
+    centre of each pixel.  Every tile is keyed by
+
+        (epoch, quantity, altitude, zoom, x, y)
+
+    and stored as float32 .npy files that are read back with mmap_mode='r',
+    so serving a map is reading arrays rather than synthesising harmonics.
+    Epoch and altitude directories are named by repr(float(value)), so
+    distinct values never share files.
+
+'''
+
+import os
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+class tileCache(object):
+    """
+    On-disk tile pyramid of field products, generated lazily.
+    """
+
+    # map product names onto the keys returned by igrfModel.geographic()
+    quantities = {'D':'declination', 'I':'inclination', 'F':'field', 'H':'horizontal',
+                  'east':'east', 'north':'north', 'up':'up'}
+
+    def __init__(self, root, size=256, dtype='float32', verbose=0):
+        self.root = root
+        self.size = size
+        self.dtype = dtype
+        self.verbose = verbose
+        self.models = {}   ;# one igrfModel per epoch label
+        self.pending = set()   ;# tiles requested but not yet generated
+
+
+    @staticmethod
+    def label(value):
+        """ Lossless name for an epoch or altitude: the shortest repr that reads back as the same float. """
+        return repr( float(value) )
+
+
+    def model(self, epoch):
+        key = self.label(epoch)
+        if key not in self.models:
+            self.models[key] = igrfModel( float(key) )
+        return self.models[key]
+
+
+    def path(self, epoch, quantity, altitude, zoom, x, y):
+        return os.path.join(self.root, self.label(epoch), self.label(altitude), quantity,
+                            str(zoom), str(x), '%d.npy' % y)
+
+
+    def bounds(self, zoom, x, y):
+        """ Longitude (west, east) and latitude (north, south) of a tile in degrees. """
+        nx, ny = 2**(zoom+1), 2**zoom
+        if not (0 <= x < nx and 0 <= y < ny):
+            raise ValueError('tile (%d,%d) outside zoom level %d' % (x, y, zoom))
+        dlon, dlat = 360.0/nx, 180.0/ny
+        return (-180.0 + x*dlon, -180.0 + (x+1)*dlon), (90.0 - y*dlat, 90.0 - (y+1)*dlat)
+
+
+    def grid(self, zoom, x, y):
+        """ Latitude and longitude of the pixel centres in a tile. """
+        (west, east), (north, south) = self.bounds(zoom, x, y)
+        edges = (np.arange(self.size) + 0.5) / self.size
+        longitude = west + (east-west) * edges
+        latitude = north + (south-north) * edges
+        return np.meshgrid(latitude, longitude, indexing='ij')
+
+
+    def generate(self, epoch, altitude, zoom, x, y):
+        """
+        Evaluate the model over one tile and store every quantity, since
+        geographic() calculates all of them at the same time anyway.  Each
+        file is written under a temporary name and renamed into place, so
+        a crash or a concurrent reader never sees a partial tile.
+        """
+        latitude, longitude = self.grid(zoom, x, y)
+        field = self.model(epoch).geographic(altitude, latitude, longitude, metadata=False)['field']
+        for quantity, name in self.quantities.items():
+            filename = self.path(epoch, quantity, altitude, zoom, x, y)
+            if not os.path.isdir(os.path.dirname(filename)):
+                try: os.makedirs(os.path.dirname(filename))
+                except OSError: pass   # made by another process in the meantime
+            temporary = '%s.%d.tmp' % (filename, os.getpid())
+            tile = np.lib.format.open_memmap(temporary, mode='w+', dtype=self.dtype, shape=latitude.shape)
+            tile[:] = field[name]
+            del tile   ;# flush to disk
+            os.rename(temporary, filename)
+        self.pending.discard( (epoch, altitude, zoom, x, y) )
+        if self.verbose: print('Generated tile %s' % str((epoch, altitude, zoom, x, y)))
+
+
+    def build(self, epoch, altitude=0.0, zoom=3):
+        """ Generate all tiles up to and including a (coarse) zoom level. """
+        for z in range(zoom+1):
+            for x in range(2**(z+1)):
+                for y in range(2**z):
+                    if not self.exists(epoch, altitude, z, x, y):
+                        self.generate(epoch, altitude, z, x, y)
+
+
+    def exists(self, epoch, altitude, zoom, x, y):
+        """ True if every quantity of a tile is on disk. """
+        return all( os.path.exists(self.path(epoch, quantity, altitude, zoom, x, y)) for quantity in self.quantities )
+
+
+    def tile(self, epoch, quantity, altitude, zoom, x, y, generate=True):
+        """
+        Return one tile as a read-only memory-mapped array.
+
+        Missing tiles are generated on demand.  With generate=False the
+        request is answered immediately from the finest cached ancestor
+        (upsampled to the tile size) and the tile is queued for fill().
+        """
+        if quantity not in self.quantities:
+            raise ValueError('unknown quantity %s, expected one of %s' % (quantity, sorted(self.quantities)))
+        self.bounds(zoom, x, y)   ;# validate
+        filename = self.path(epoch, quantity, altitude, zoom, x, y)
+        if not os.path.exists(filename):
+            if not generate:
+                self.pending.add( (epoch, altitude, zoom, x, y) )
+                return self.coarse(epoch, quantity, altitude, zoom, x, y)
+            self.generate(epoch, altitude, zoom, x, y)
+        return np.load(filename, mmap_mode='r')
+
+
+    def coarse(self, epoch, quantity, altitude, zoom, x, y):
+        """
+        Approximate a tile from the finest cached tile at a lower zoom level
+        that covers it, or None if no ancestor is available.
+        """
+        for level in range(1, zoom+1):
+            scale = 2**level
+            filename = self.path(epoch, quantity, altitude, zoom-level, x//scale, y//scale)
+            if not os.path.exists(filename): continue
+            parent = np.load(filename, mmap_mode='r')
+            # pixels in the parent covering this tile, then repeat to full size
+            step = self.size // scale
+            if step == 0: continue
+            i0, j0 = (y % scale) * step, (x % scale) * step
+            block = np.asarray(parent[i0:i0+step, j0:j0+step])
+            block = np.repeat( np.repeat(block, scale, axis=0), scale, axis=1 )
+            pad = self.size - block.shape[0]
+            return np.pad(block, ((0,pad),(0,pad)), mode='edge') if pad else block
+        return None
+
+
+    def fill(self):
+        """ Generate all tiles that were requested while missing. """
+        for key in sorted(self.pending):
+            self.generate(*key)
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.root = tempfile.mkdtemp()
+        self.cache = tileCache(self.root, size=8)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def test_tile(self):
+        tile = self.cache.tile(2010.0, 'D', 0.0, 1, 2, 1)
+        self.assertEqual(tile.shape, (8,8))
+        latitude, longitude = self.cache.grid(1, 2, 1)
+        expect = igrfModel(2010.0).geographic(0.0, latitude[3,5], longitude[3,5])['field']['declination']
+        self.assertTrue( np.abs(tile[3,5] - expect) < 1e-3 )
+
+    def test_keys(self):
+        # nearby altitudes and epochs are kept apart
+        cache = self.cache
+        self.assertNotEqual( cache.path(2010.0, 'F', 1234567.0, 0, 0, 0), cache.path(2010.0, 'F', 1234568.0, 0, 0, 0) )
+        self.assertNotEqual( cache.path(2010.0001, 'F', 0.0, 0, 0, 0), cache.path(2010.0004, 'F', 0.0, 0, 0, 0) )
+        self.assertEqual( cache.path(2010, 'F', 0, 0, 0, 0), cache.path(2010.0, 'F', 0.0, 0, 0, 0) )
+        self.assertTrue( cache.model(2010.0001) is not cache.model(2010.0004) )
+        self.assertTrue( cache.model(2010) is cache.model(2010.0) )
+
+    def test_coarse(self):
+        self.assertTrue( self.cache.tile(2010.0, 'F', 0.0, 2, 3, 1, generate=False) is None )
+        self.cache.build(2010.0, zoom=0)
+        tile = self.cache.tile(2010.0, 'F', 0.0, 2, 3, 1, generate=False)
+        self.assertEqual(tile.shape, (8,8))
+        self.assertEqual(len(self.cache.pending), 1)
+        self.cache.fill()
+        self.assertEqual(len(self.cache.pending), 0)
+        exact = self.cache.tile(2010.0, 'F', 0.0, 2, 3, 1, generate=False)
+        self.assertTrue( np.all( np.abs(exact - tile) < 0.2*np.abs(exact) ) )
+
+    def test_partial(self):
+        # no temporary files are left, and a tile with a missing quantity is built again
+        self.cache.build(2010.0, zoom=0)
+        files = [ name for path, dirs, names in os.walk(self.root) for name in names ]
+        self.assertEqual( len(files), 2 * len(tileCache.quantities) )
+        self.assertFalse( any( name.endswith('.tmp') for name in files ) )
+        os.remove( self.cache.path(2010.0, 'D', 0.0, 0, 1, 0) )
+        self.assertFalse( self.cache.exists(2010.0, 0.0, 0, 1, 0) )
+        self.cache.build(2010.0, zoom=0)
+        self.assertTrue( self.cache.exists(2010.0, 0.0, 0, 1, 0) )
+
+if __name__ == "__main__":
+    unittest.main()
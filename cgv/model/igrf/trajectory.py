@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+'''
+ trajectory.py
+
+    Main field along densely sampled satellite tracks, evaluating the model
+    exactly only at adaptively chosen knots and filling the other samples
+    by cubic spline interpolation in time.
+
+    from igrf_model import igrfModel
+    from trajectory import trajectoryEvaluator
+    track = trajectoryEvaluator( igrfModel(2015), tolerance=0.05 )
+    result = track.geographic(time, height, latitude, longitude, outputs=('north','east','up','F'))
+    result['field']['field'], result['_']['evaluated']
+
+    Knots start every `spacing` samples (and on both sides of any time gap
+    longer than max_gap).  Each interval between knots is then checked at
+    its middle sample: the exact field there is compared with the spline
+    through the existing knots, and intervals where any vector component
+    is off by more than the tolerance [nT] are bisected and checked again.
+    The midpoints become knots either way, so every model call improves the
+    spline.  All midpoints of one pass are evaluated in one vectorized
+    geographic() call.  Derived quantities (F, H, D, I) are computed from
+    the interpolated vector, as in igrfModel.geographic().
+
+    time is in seconds (or numpy datetime64) and must be increasing.
+'''
+
+import numpy as np
+import unittest
+
+from igrf_model import igrfModel
+
+
+class trajectoryEvaluator(object):
+    """
+    Adaptive knot selection and spline interpolation of the model along a track.
+    """
+
+    vector = ['east', 'north', 'up']
+    derived = ['field', 'horizontal', 'declination', 'inclination']
+
+    def __init__(self, model=None, tolerance=0.1, spacing=256, max_gap=None, verbose=0):
+        self.model = igrfModel() if model is None else model
+        self.tolerance = tolerance  ;# nT, largest interpolation error at the check points
+        self.spacing = spacing      ;# samples between the initial knots
+        self.max_gap = max_gap      ;# seconds, no interpolation across longer gaps
+        self.verbose = verbose
+
+
+    def _exact(self, index, height, latitude, longitude):
+        b = self.model.geographic(height[index], latitude[index], longitude[index], metadata=False,
+                                  outputs=self.vector)['field']
+        return np.column_stack( [b[name] for name in self.vector] )
+
+
+    def interpolate(self, time, index, values, samples):
+        """
+        Spline through the knots at sorted sample indices, one spline per
+        stretch of track without gaps longer than max_gap.
+        """
+        from scipy.interpolate import CubicSpline
+        segments = [ np.arange(len(index)) ]
+        if self.max_gap is not None:
+            gaps = (np.diff(index) == 1) & (np.diff(time[index]) > self.max_gap)   ;# knots either side of a gap
+            segments = np.split( segments[0], np.flatnonzero(gaps) + 1 )
+        result = np.empty( (len(samples), 3) )
+        for segment in segments:
+            k = index[segment]
+            inside = (samples >= k[0]) & (samples <= k[-1])
+            if len(k) == 1: result[inside] = values[segment]
+            else: result[inside] = CubicSpline( time[k], values[segment], axis=0 )( time[samples[inside]] )
+        return result
+
+
+    def knots(self, time, height, latitude, longitude):
+        """ Sorted knot indices and the exact (east, north, up) field [nT] at them. """
+        n = len(time)
+        knots = set( range(0, n, self.spacing) ) | set([n-1])
+        if self.max_gap is not None:
+            gaps = np.flatnonzero( np.diff(time) > self.max_gap )
+            knots |= set(gaps) | set(gaps + 1)
+        index = np.array( sorted(knots) )
+        values = self._exact(index, height, latitude, longitude)
+
+        # intervals still to be checked, as (left, right) sample indices
+        left, right = index[:-1], index[1:]
+        passes = 0
+        while True:
+            keep = right - left > 1
+            left, right = left[keep], right[keep]
+            if len(left) == 0 or len(index) < 2: break
+            middle = (left + right) // 2
+            exact = self._exact(middle, height, latitude, longitude)
+            error = np.max( np.abs( self.interpolate(time, index, values, middle) - exact ), axis=1 )
+
+            order = np.argsort( np.concatenate([index, middle]) )
+            index = np.concatenate([index, middle])[order]
+            values = np.concatenate([values, exact])[order]
+            bad = error > self.tolerance
+            left, right = np.concatenate([left[bad], middle[bad]]), np.concatenate([middle[bad], right[bad]])
+            passes += 1
+            if self.verbose: print('pass %d: %d knots, %d intervals to refine' % (passes, len(index), bad.sum()))
+        return index, values
+
+
+    def geographic(self, time, height, latitude, longitude, outputs=None):
+        """
+        Field along a track of geodetic positions (as for igrfModel.geographic)
+        at increasing times.  Returns {'field':..., '_':...} with the knot
+        indices and the number of model evaluations in '_'.
+        """
+        time = np.asarray(time)
+        if np.issubdtype(time.dtype, np.datetime64):
+            time = (time - time[0]).astype('timedelta64[ns]').astype('float') * 1.0e-9
+        time = np.asarray(time, dtype='float')
+        height, latitude, longitude = [ np.broadcast_to(np.asarray(v, dtype='float'), time.shape)
+                                        for v in (height, latitude, longitude) ]
+        if outputs is None:
+            outputs = self.vector + self.derived
+        need = self.model._outputs(outputs)
+        if need - set(self.derived) - set(self.vector) - set(['r','theta','phi']):
+            raise ValueError('trajectoryEvaluator provides geodetic components and quantities derived from them')
+
+        index, values = self.knots(time, height, latitude, longitude)
+        B = self.interpolate(time, index, values, np.arange(len(time)))
+        B[index] = values   ;# exact at the knots
+
+        b = dict( (name, B[:,i]) for i, name in enumerate(self.vector) )
+        if 'field' in need:
+            b['field'] = np.sqrt( b['north']**2 + b['east']**2 + b['up']**2 )
+        if 'horizontal' in need:
+            b['horizontal'] = np.sqrt( b['north']**2 + b['east']**2 )
+        if 'declination' in need:
+            b['declination'] = np.arctan2( b['east'], b['north'] ) / self.model.dtor
+        if 'inclination' in need:
+            b['inclination'] = np.arctan2( b['up'], b['horizontal'] ) / self.model.dtor
+        field = dict( (name, b[name]) for name in need if name in b )   ;# as igrfModel.geographic(), with dependencies
+        return {'field':field, '_':{'knots':index, 'evaluated':len(index), 'samples':len(time),
+                                    'tolerance':self.tolerance, 'year':self.model.year}}
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        # ten minutes of a 450 km polar orbit at 50 Hz
+        self.time = np.arange(0.0, 600.0, 0.02)
+        angle = 2*np.pi * self.time / 5580.0
+        self.latitude = np.degrees( np.arcsin( np.sin(angle + 0.3) * np.sin(np.radians(87.0)) ) )
+        self.longitude = np.mod( 250.0 + np.degrees( np.arctan2( np.sin(angle + 0.3) * np.cos(np.radians(87.0)),
+                                                                np.cos(angle + 0.3) ) ) - self.time/240.0, 360.0 )
+        self.height = 450e3 + 10e3 * np.sin(angle)
+        self.model = igrfModel(2015)
+
+    def test_track(self):
+        track = trajectoryEvaluator(self.model, tolerance=0.01)
+        result = track.geographic(self.time, self.height, self.latitude, self.longitude)
+        exact = self.model.geographic(self.height, self.latitude, self.longitude)['field']
+        for name in ['north', 'east', 'up', 'field']:
+            self.assertTrue( np.max( np.abs( result['field'][name] - exact[name] ) ) < 0.05 )
+        self.assertTrue( np.max( np.abs( result['field']['declination'] - exact['declination'] ) ) < 1e-3 )
+        self.assertTrue( result['_']['evaluated'] * 10 < len(self.time) )
+
+    def test_gaps(self):
+        # no interpolation across a gap in the track, exact values at knots
+        keep = (self.time < 200.0) | (self.time > 260.0)
+        track = trajectoryEvaluator(self.model, tolerance=0.01, max_gap=1.0)
+        time, height, lat, lon = self.time[keep], self.height[keep], self.latitude[keep], self.longitude[keep]
+        result = track.geographic(time, height, lat, lon, outputs=('F',))
+        self.assertTrue( 'field' in result['field'] and 'declination' not in result['field'] )
+        exact = self.model.geographic(height, lat, lon, outputs=('F',))['field']['field']
+        self.assertTrue( np.max( np.abs( result['field']['field'] - exact ) ) < 0.05 )
+        k = np.flatnonzero( np.diff(time) > 1.0 )[0]
+        self.assertTrue( k in result['_']['knots'] and k+1 in result['_']['knots'] )
+        self.assertRaises( ValueError, track.geographic, time, height, lat, lon, outputs=('V',) )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+'''
+ transforms.py
+
+    Time dependent geophysical coordinate transforms between GEO, GEI, GSE,
+    GSM and SM for arrays of times and positions.
+
+    from transforms import coordinateTransform
+    T = coordinateTransform()
+    gsm = T.transform(times, xyz, source='GEO', target='GSM')
+
+    times are numpy datetime64 (UTC) and xyz is an (n,3) array in any
+    units.  Rotation matrices are built once per unique timestamp and
+    applied as one batched matrix product.  The dipole axis comes from g10,
+    g11, h11 of the model coefficients, once per (UTC) day.  Timestamps that
+    come back in a later call (eg. a fixed set of epochs) are kept in a
+    bounded LRU cache of sorted arrays, so lookups are vectorized and a long
+    ephemeris of new times does not churn through the cache.
+
+    Hapgood, M.A. (1992), Space physics coordinate transformations: a user
+    guide, Planet. Space Sci., 40(5), 711-717
+'''
+
+import numpy as np
+import unittest
+
+import coefficients
+from igrf_model import igrfModel
+from residual import decimal_year
+
+
+def _rotation(angle, axis):
+    """ Hapgood's <angle, axis> rotation matrices for an array of angles [degrees]. """
+    c, s = np.cos( np.radians(angle) ), np.sin( np.radians(angle) )
+    one, zero = np.ones_like(c), np.zeros_like(c)
+    if axis == 'X': rows = [[one, zero, zero], [zero, c, s], [zero, -s, c]]
+    elif axis == 'Y': rows = [[c, zero, -s], [zero, one, zero], [s, zero, c]]
+    else: rows = [[c, s, zero], [-s, c, zero], [zero, zero, one]]
+    return np.moveaxis( np.array(rows), [0,1], [-2,-1] )   ;# (n,3,3)
+
+
+def hapgood_coefficients(time, axis):
+    """
+    Rotation matrices (n,3,3) from GEO to each of GEI, GSE, GSM, SM for
+    datetime64 times (n,) and (north) dipole axis unit vectors in GEO (n,3).
+    """
+    time = np.asarray(time).astype('datetime64[ns]')
+    day = time.astype('datetime64[D]')
+    MJD = (day - np.datetime64('1858-11-17')).astype('float')
+    H = (time - day).astype('float') / 3600.0e9   ;# UT hours
+    T0 = (MJD - 51544.5) / 36525.0
+
+    theta = 100.461 + 36000.770*T0 + 15.04107*H   ;# Greenwich mean sidereal time
+    epsilon = 23.439 - 0.013*T0                    ;# obliquity of the ecliptic
+    M = np.radians( 357.528 + 35999.050*T0 + 0.04107*H )   ;# mean anomaly
+    Lambda = 280.460 + 36000.772*T0 + 0.04107*H    ;# mean longitude
+    lsun = Lambda + (1.915 - 0.0048*T0)*np.sin(M) + 0.020*np.sin(2*M)   ;# ecliptic longitude
+
+    T1 = _rotation(theta, 'Z')                                          ;# GEI -> GEO
+    T2 = np.matmul( _rotation(lsun, 'Z'), _rotation(epsilon, 'X') )     ;# GEI -> GSE
+    GEI = np.swapaxes(T1, -1, -2)
+    GSE = np.matmul(T2, GEI)
+
+    Qe = np.einsum('nij,nj->ni', GSE, axis)   ;# dipole axis in GSE
+    psi = np.degrees( np.arctan2( Qe[:,1], Qe[:,2] ) )
+    GSM = np.matmul( _rotation(-psi, 'X'), GSE )
+    mu = np.degrees( np.arctan2( Qe[:,0], np.sqrt( Qe[:,1]**2 + Qe[:,2]**2 ) ) )   ;# dipole tilt
+    SM = np.matmul( _rotation(mu, 'Y'), GSM )   ;# sign chosen so that the dipole axis is SM z
+    return {'GEI':GEI, 'GSE':GSE, 'GSM':GSM, 'SM':SM, 'tilt':mu}
+
+
+class coordinateTransform(object):
+    """
+    Batched GEO/GEI/GSE/GSM/SM conversions with cached rotation matrices.
+    """
+
+    frames = ['GEO', 'GEI', 'GSE', 'GSM', 'SM']
+
+    def __init__(self, model=None, cache_size=10000):
+        self.model = igrfModel() if model is None else model
+        self.cache_size = cache_size
+        self.keys = np.zeros(0, dtype='int64')   ;# cached times [ns], sorted
+        self.cache = np.zeros( [0, len(self.frames), 3, 3] )   ;# GEO to each frame at each cached time
+        self.used = np.zeros(0, dtype='int64')   ;# call number each cached time was last used
+        self.recent = np.zeros(0, dtype='int64') ;# times seen once lately, cached if they come back
+        self.calls = 0
+        self.axes = {}   ;# day -> dipole axis in GEO
+
+
+    def dipole_axis(self, day):
+        """
+        Unit vector along the northern geomagnetic pole in GEO for one day,
+        from the dipole coefficients of the model's coefficient source (the
+        model itself is not changed).
+        """
+        if day not in self.axes:
+            g, h = coefficients.load(self.model.source).at( float( decimal_year( np.datetime64(day, 'D') ) ) )
+            axis = -np.array( [g[coefficients.index(1,1)], h[coefficients.index(1,1)], g[coefficients.index(1,0)]] )
+            self.axes[day] = axis / np.sqrt( np.sum(axis**2) )
+        return self.axes[day]
+
+
+    def _store(self, keys, matrices):
+        """ Add matrices for new times to the cache, dropping the least recently used beyond cache_size. """
+        keys = np.concatenate( [self.keys, keys] )
+        cache = np.concatenate( [self.cache, matrices] )
+        used = np.concatenate( [self.used, np.full(len(matrices), self.calls, dtype='int64')] )
+        keep = np.argsort(-used, kind='mergesort')[0:self.cache_size]
+        keep = keep[ np.argsort(keys[keep]) ]
+        self.keys, self.cache, self.used = keys[keep], cache[keep], used[keep]
+
+
+    def matrices(self, time):
+        """ Rotation matrices (n,5,3,3) from GEO to each frame, built once per unique time. """
+        time = np.atleast_1d( np.asarray(time).astype('datetime64[ns]') )
+        unique, index = np.unique(time, return_inverse=True)
+        keys = unique.astype('int64')
+        result = np.empty( [len(unique), len(self.frames), 3, 3] )
+        self.calls += 1
+
+        k = np.minimum( np.searchsorted(self.keys, keys), max(len(self.keys)-1, 0) )
+        cached = self.keys[k] == keys if len(self.keys) else np.zeros(len(keys), dtype='bool')
+        result[cached] = self.cache[k[cached]]
+        self.used[k[cached]] = self.calls
+
+        missing = np.flatnonzero(~cached)
+        if len(missing):
+            days, day = np.unique( unique[missing].astype('datetime64[D]'), return_inverse=True )
+            axis = np.array( [self.dipole_axis(d) for d in days.astype('int64')] )[day]
+            m = hapgood_coefficients(unique[missing], axis)
+            result[missing] = np.stack( [np.broadcast_to(np.eye(3), m['GEI'].shape)] + [m[name] for name in self.frames[1:]], axis=1 )
+            # only times that come back are worth keeping, one-off times are just remembered
+            again = np.in1d(keys[missing], self.recent)
+            if np.any(again): self._store(keys[missing[again]], result[missing[again]])
+            self.recent = np.concatenate( [self.recent, keys[missing[~again]]] )[-self.cache_size:]
+
+        return result[index]
+
+
+    def transform(self, time, xyz, source='GEO', target='GSM'):
+        """ Convert (n,3) positions or vectors between frames at datetime64 times. """
+        for frame in [source, target]:
+            if frame not in self.frames:
+                raise ValueError('unknown frame %s, expected one of %s' % (frame, self.frames))
+        xyz = np.atleast_2d( np.asarray(xyz, dtype='float') )
+        time = np.broadcast_to( np.asarray(time).astype('datetime64[ns]'), xyz.shape[:1] )
+        if source == target: return xyz.copy()
+        m = self.matrices(time)
+        A = m[:, self.frames.index(source)]
+        B = m[:, self.frames.index(target)]
+        geo = np.einsum('nji,nj->ni', A, xyz)   ;# inverse rotation (transpose) back to GEO
+        return np.einsum('nij,nj->ni', B, geo)
+        ########################################################################
+
+
+class BasicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.T = coordinateTransform( igrfModel(2015) )
+        self.time = np.datetime64('2015-06-21T12:00') + np.arange(5) * np.timedelta64(6,'h')
+
+    def test_sidereal_time(self):
+        # GEO x axis is at right ascension = GMST, 280.46 degrees at J2000
+        x = self.T.transform(np.datetime64('2000-01-01T12:00'), [1.0, 0.0, 0.0], 'GEO', 'GEI')[0]
+        self.assertAlmostEqual( np.degrees( np.arctan2(x[1], x[0]) ) % 360.0, 280.46, places=2 )
+
+    def test_axes(self):
+        T = self.T
+        sun = T.transform(self.time, np.tile([1.0, 0.0, 0.0], (5,1)), 'GSE', 'GSM')
+        self.assertTrue( np.allclose( sun, [1.0, 0.0, 0.0] ) )
+        axis = T.dipole_axis( np.datetime64('2015-06-21', 'D').astype('int64') )
+        z = T.transform(self.time, np.tile(axis, (5,1)), 'GEO', 'SM')
+        self.assertTrue( np.allclose( z, [0.0, 0.0, 1.0], atol=1e-5 ) )   ;# axis is updated daily
+        self.assertEqual( T.model.year, 2015 )   ;# caller's model is left alone
+        d = igrfModel(2015.0).dipole()
+        expect = -np.array( [d['g11'], d['h11'], d['g10']] ) / d['B0']
+        self.assertTrue( np.allclose( T.dipole_axis( np.datetime64('2015-01-01', 'D').astype('int64') ), expect ) )
+
+    def test_round_trip(self):
+        xyz = np.random.RandomState(1).normal(size=(5,3))
+        gse = self.T.transform(self.time, xyz, 'GEO', 'GSE')
+        back = self.T.transform(self.time, gse, 'GSE', 'GEO')
+        self.assertTrue( np.allclose( back, xyz ) )
+        self.assertTrue( np.allclose( np.sum(gse**2, axis=1), np.sum(xyz**2, axis=1) ) )
+        self.assertEqual( len(self.T.keys), 5 )   ;# one set of matrices per unique time, used twice
+
+    def test_ephemeris(self):
+        # a long series of new times is not cached, and the dipole axis is found once per day
+        T = coordinateTransform( igrfModel(2015), cache_size=100 )
+        time = np.datetime64('2015-03-01') + np.arange(0, 3*86400, 10) * np.timedelta64(1,'s')
+        xyz = np.tile( [1.0, 2.0, 3.0], (len(time),1) )
+        gsm = T.transform(time, xyz, 'GEO', 'GSM')
+        self.assertEqual( (len(T.keys), len(T.recent), len(T.axes)), (0, 100, 3) )
+        expect = coordinateTransform( igrfModel(2015) ).transform(time[-100:], xyz[-100:], 'GEO', 'GSM')
+        self.assertTrue( np.allclose( T.transform(time[-100:], xyz[-100:], 'GEO', 'GSM'), expect ) )
+        self.assertTrue( np.allclose( gsm[-100:], expect ) )
+        self.assertEqual( len(T.keys), 100 )   ;# repeated times are cached
+        self.assertTrue( np.allclose( T.transform(time[-100:], xyz[-100:], 'GEO', 'GSM'), expect ) )
+
+if __name__ == "__main__":
+    unittest.main()